@@ -3,6 +3,18 @@ class Configuration(object):
     w_rnn_units = 256
     ch_rnn_units = 32
     ch_em_size = 32
+
+    #Maximum number of words whose prefix/suffix vectors are cached at inference.
+    #0 disables the cache.
+    ch_cache_size = 100000
+
+    #Prefix of the feature table exported by 'python tagger.py export'.
+    #At test time, in-vocabulary words read their features from it. None disables it.
+    feature_table = None
+
+    #At test time, run the encoder and predictor with dynamic int8 LSTM and Linear layers,
+    #saved by 'python tagger.py quantize'. Quantized layers run on CPU only.
+    quantized = False
     tag_em_size = 32
     dec_rnn_units = 256
     dropout = 0.5
@@ -11,9 +23,22 @@ class Configuration(object):
     max_gradient_norm = 5.
     max_epochs = 128
     early_stopping = 10
-    batch_size = 32
+    #A batch has at most batch_size sentences, batch_tokens padded words
+    #(sentences x max_s_len) and batch_chars padded chars (x max_w_len),
+    #so short sentences make larger batches. None disables a budget.
+    batch_size = 128
+    batch_tokens = 512
+    batch_chars = 10240
     seed = 125
 
+    #CRF partition and Viterbi over the top crf_top_k tags of each step by emission score,
+    #an approximation for large tag sets (CCG). None runs the exact CRF.
+    crf_top_k = None
+
+    #At test time, exact CRF batches have at most crf_batch_scores (batch size x tags x tags)
+    #transition scores, the size of the score tensor of each Viterbi step.
+    crf_batch_scores = 2**24
+
     task = 'en_NER'
     #task = 'de_NER'
     #task = 'CCG'
@@ -22,6 +47,10 @@ class Configuration(object):
     w_dic = './data/en_embeddings/' + 'glove.100.dic.txt'
     w_vector = './data/en_embeddings/' + 'glove.100.vectors.txt'
 
+    #Prefix of the binary embeddings cache.
+    #It is rebuilt whenever w_dic or w_vector change.
+    w_cache = './data/en_embeddings/' + 'glove.100.cache'
+
     ch_dic = './data/en_ner_data/' + 'en.ner.chars'
     tag_dic = './data/en_ner_data/' + 'en.ner.tags'
     train_raw = './data/en_ner_data/' + 'ner.train.raw'
@@ -29,6 +58,31 @@ class Configuration(object):
     dev_raw = './data/en_ner_data/' + 'ner.dev.raw'
     dev_ref = './data/en_ner_data/' + 'ner.dev.ref'
 
+    #Read train and dev sets from their compiled id arrays (x.raw.compiled.*.npy).
+    #They are compiled on first use or by 'python tagger.py compile'.
+    compile_corpus = True
+
+    #Number of processes which compile the corpus, 0 compiles in the main process.
+    compile_workers = 4
+
+    #Batch training sentences of similar length together (requires compile_corpus).
+    #Sentences are sorted by length inside pools of bucket_pool batches.
+    bucketing = True
+    bucket_pool = 100
+
+    #Raw training data (compile_corpus = False) is shuffled
+    #through a buffer of shuffle_buffer sentences.
+    shuffle_buffer = 10000
+
+    #Maximum number of distinct raw tokens whose ids are memoized.
+    token_cache_size = 500000
+
+    #Batches are parsed, padded and converted to tensors by background threads
+    #while the model runs. prefetch_depth is the maximum number of batches in flight.
+    #With prefetch_workers = 0, batches are built in the main loop.
+    prefetch_workers = 2
+    prefetch_depth = 8
+
 
     """ Model Type """
     #Independent prediction of the tags.
@@ -55,7 +109,9 @@ class Configuration(object):
     #n_step = 2
 
     #For inference in decoder RNNs, we have greedy search or beam search.
+    #Speculative search gives the greedy tags with a few parallel passes of the decoder RNN.
     #Specify the beam size.
     #search = 'greedy'
     #search = 'beam'
+    #search = 'speculative'
     #beamsize = 10
@@ -0,0 +1,117 @@
+from config import Configuration
+from modules.crf import CRF
+from torch.autograd import Variable
+import torch
+import numpy as np
+import sys
+import time
+import resource
+import multiprocessing
+
+hasCuda = torch.cuda.is_available()
+
+def random_batch(cfg, batch_size, max_s_len):
+    """Sets a random batch of hidden vectors and gold tags, with sentences of random lengths."""
+    s_len = np.random.randint(1, max_s_len + 1, size=batch_size)
+    s_len[0] = max_s_len
+    w_mask = (np.arange(max_s_len).reshape(1, -1) < s_len.reshape(-1, 1)).astype(np.float32)
+    tag = np.random.randint(0, cfg.tag_size, size=(batch_size, max_s_len))
+
+    cfg.d_batch_size = batch_size
+    cfg.max_s_len = max_s_len
+    cfg.B = {
+            'w_mask': torch.from_numpy(w_mask),
+            'tag': torch.from_numpy(tag),
+            's_len': torch.from_numpy(s_len)
+            }
+
+    H = torch.randn(batch_size, max_s_len, cfg.w_rnn_units)
+    return Variable(H.cuda()) if hasCuda else Variable(H)
+
+def run(cfg, crf, H, repeats):
+    """Returns the average seconds of a training step (forward and backward) and of decoding."""
+    crf.train()
+    start = time.time()
+    for _ in range(repeats):
+        crf.zero_grad()
+        loss = crf.loss(crf(H))
+        loss.backward()
+    if hasCuda: torch.cuda.synchronize()
+    train_time = (time.time() - start) / repeats
+
+    crf.eval()
+    start = time.time()
+    for _ in range(repeats):
+        crf.predict(H)
+    decode_time = (time.time() - start) / repeats
+    return train_time, decode_time
+
+def measure(cfg, crf, H, repeats, queue):
+    """
+    Runs the CRF of cfg.crf_top_k in a forked process, so its peak memory is not the one of another k.
+    Puts the times, the decoded tags and the growth of the peak resident memory (MB) in the queue.
+    """
+    start = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    train_time, decode_time = run(cfg, crf, H, repeats)
+    crf.eval()
+    preds = crf.predict(H)
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    queue.put((train_time, decode_time, preds, (peak - start) / 1024.0))
+    return
+
+"""
+    Compares the exact CRF with the pruned CRF (top k tags of each step)
+    on random batches with a large tag set:
+    python crf_benchmark.py [tag size] [k values] [batch size] [length]
+    example: python crf_benchmark.py 1288 8,16,32,64 8 20
+    The exact CRF keeps a (batch size, tags, tags) tensor of each step for the backward pass,
+    so large batches may not fit in memory.
+    On CPU, each k runs in a forked process, and the peak memory is the growth of its resident memory.
+"""
+if __name__ == "__main__":
+    tag_size = int(sys.argv[1]) if len(sys.argv) > 1 else 1288
+    top_ks = [int(k) for k in sys.argv[2].split(',')] if len(sys.argv) > 2 else [8, 16, 32, 64]
+    batch_size = int(sys.argv[3]) if len(sys.argv) > 3 else 8
+    max_s_len = int(sys.argv[4]) if len(sys.argv) > 4 else 20
+    repeats = 3
+
+    cfg = Configuration()
+    cfg.tag_size = tag_size
+    np.random.seed(cfg.seed)
+    torch.manual_seed(cfg.seed)
+
+    crf = CRF(cfg)
+    if hasCuda: crf.cuda()
+    H = random_batch(cfg, batch_size, max_s_len)
+
+    print 'Tags:{} | Batch size:{} | Length:{}'.format(tag_size, batch_size, max_s_len)
+
+    exact_preds = None
+    for k in [None] + top_ks:
+        cfg.crf_top_k = k
+        if hasCuda:
+            torch.cuda.reset_max_memory_allocated()
+            train_time, decode_time = run(cfg, crf, H, repeats)
+            crf.eval()
+            preds = crf.predict(H)
+            memory = torch.cuda.max_memory_allocated() / 2.0**20
+        else:
+            queue = multiprocessing.Queue()
+            process = multiprocessing.Process(target=measure, args=(cfg, crf, H, repeats, queue))
+            process.start()
+            train_time, decode_time, preds, memory = queue.get()
+            process.join()
+
+        #Agreement of the decoded tags with the exact CRF.
+        mask = cfg.B['w_mask'].numpy() > 0
+        if exact_preds is None: exact_preds = preds
+        agreement = np.mean(preds[mask] == exact_preds[mask])
+
+        name = 'exact' if k is None else 'top {}'.format(k)
+        print '{} | Train step:{:.3f} seconds | Decoding:{:.3f} seconds | Agreement:{:.3f} | Peak memory:{:.1f} MB'.format(
+                                                name,
+                                                train_time,
+                                                decode_time,
+                                                agreement,
+                                                memory
+                                                )
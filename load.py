@@ -1,13 +1,197 @@
 import itertools
+from itertools import izip
 import re
+import os
+import sys
+import json
+import threading
+import Queue
+import multiprocessing
+import collections
+import shutil
 import numpy as np
-from random import shuffle
 import codecs
 
+#Precompiled patterns to detect dates, times and other digits.
+#Change these patterns for more rules to detect dates and times.
+DATE_RE = re.compile(r'\d{4}-\d{2}-\d{2}')
+TIME_RE = re.compile(r'\d+:\d+:[\d.]+')
+DIGIT_RE = re.compile(r'\d')
+
+class TokenCache(object):
+    """
+        Memoizes the ids of raw tokens: token -> (word id, cap id, char ids).
+        The cache is bounded; once it is full, new tokens are not admitted,
+        which keeps the frequent tokens of Zipfian data in the cache.
+        With several prefetch workers, the hit/miss counters are approximate.
+    """
+    def __init__(self, cfg, size):
+        self.cfg = cfg
+        self.size = size
+        self.memo = {}
+        self.hits = 0
+        self.misses = 0
+
+    def lookup(self, token):
+        ids = self.memo.get(token)
+        if ids is not None:
+            self.hits += 1
+            return ids
+
+        self.misses += 1
+        cfg = self.cfg
+        word_id = cfg.data['w_id'].get(token.lower())
+        if word_id is not None:
+            #The chars of the dictionary words are precomputed.
+            start = cfg.data['w_ch_off'][word_id]
+            end = cfg.data['w_ch_off'][word_id+1]
+            chars = tuple(cfg.data['w_ch'][start:end].tolist())
+
+        else:
+            word_id = process_word(cfg, token)
+            chars = tuple(process_chars(cfg, token))
+
+        ids = (word_id, capalize_word(token), chars)
+        if len(self.memo) < self.size:
+            self.memo[token] = ids
+
+        return ids
+
+    def hit_rate(self):
+        lookups = self.hits + self.misses
+        if lookups==0:
+            return 0.0
+
+        return float(self.hits) / lookups
+
+def file_stamp(paths):
+    """Identifies the current version of the files by their path, size and modification time."""
+    stamp = []
+    for path in paths:
+        st = os.stat(path)
+        stamp.append([os.path.abspath(path), st.st_size, st.st_mtime])
+    return stamp
+
+def valid_cache(prefix, stamp):
+    """Checks whether the cache with the prefix was built from the files identified by stamp."""
+    if not os.path.exists(prefix + '.meta'):
+        return False
+
+    with open(prefix + '.meta', 'r') as fd:
+        try:
+            return json.load(fd) == stamp
+        except ValueError:
+            return False
+
+def save_cache_stamp(prefix, stamp):
+    #The stamp should be written last,
+    #so an interrupted build is never considered valid.
+    with open(prefix + '.meta', 'w') as fd:
+        json.dump(stamp, fd)
+    return
+
+def build_embeddings_cache(cfg, stamp):
+    """
+        Converts the text word vectors and their dictionary into a binary cache:
+        prefix.vectors.npy: float32 matrix of the vectors.
+        prefix.words: the dictionary words joined by new lines.
+    """
+    print "INFO: Building the binary cache of word embeddings!"
+    word_vectors = np.loadtxt(cfg.w_vector, dtype=np.float32)
+    with codecs.open(cfg.w_dic, 'r', 'utf-8') as fd:
+        words = [line.strip() for line in fd]
+
+    try:
+        np.save(cfg.w_cache + '.vectors.npy', word_vectors)
+        with codecs.open(cfg.w_cache + '.words', 'w', 'utf-8') as fd:
+            fd.write(u'\n'.join(words))
+        save_cache_stamp(cfg.w_cache, stamp)
+
+    except (IOError, OSError) as e:
+        print "INFO: Could not write the embeddings cache: ", e
+
+    return words, word_vectors
+
+def load_word_vectors(cfg):
+    """Loads the starter word vectors, using the binary cache if it is up to date."""
+    stamp = file_stamp([cfg.w_vector, cfg.w_dic])
+    if not valid_cache(cfg.w_cache, stamp):
+        return build_embeddings_cache(cfg, stamp)
+
+    word_vectors = np.load(cfg.w_cache + '.vectors.npy', mmap_mode='r')
+    with codecs.open(cfg.w_cache + '.words', 'r', 'utf-8') as fd:
+        words = fd.read().split(u'\n')
+
+    return words, word_vectors
+
+def build_chars_cache(cfg, words, stamp):
+    """
+        Builds the char inventory: the chars of ch_dic, followed by the new chars of words in order.
+        It also maps every word to the ids of its lowercased chars, as process_chars does.
+        prefix.chars: the chars joined by new lines.
+        prefix.w_ch.npy, prefix.w_ch_off.npy: the char ids of word i are w_ch[w_ch_off[i]:w_ch_off[i+1]].
+    """
+    print "INFO: Building the cache of characters!"
+    with codecs.open(cfg.ch_dic, 'r', 'utf-8') as fd:
+        chars = [line.strip() for line in fd]
+
+    seen = set(chars)
+    for w in words:
+        for ch in w:
+            if ch not in seen:
+                seen.add(ch)
+                chars.append(ch)
+
+    #The final ch_id, where pad is the last char.
+    ch_id = {v:k for k,v in enumerate(chars + [cfg.ch_pad])}
+    pad_id = ch_id[cfg.ch_pad]
+
+    W_Ch = []
+    W_Ch_Off = [0]
+    for w in words:
+        W_Ch.extend([ch_id.get(ch, pad_id) for ch in w.lower()])
+        W_Ch_Off.append(len(W_Ch))
+
+    w_ch = np.array(W_Ch, dtype=np.int32)
+    w_ch_off = np.array(W_Ch_Off, dtype=np.int64)
+
+    prefix = cfg.w_cache + '.ch'
+    try:
+        with codecs.open(prefix + '.chars', 'w', 'utf-8') as fd:
+            fd.write(u'\n'.join(chars))
+        np.save(prefix + '.w_ch.npy', w_ch)
+        np.save(prefix + '.w_ch_off.npy', w_ch_off)
+        save_cache_stamp(prefix, stamp)
+
+    except (IOError, OSError) as e:
+        print "INFO: Could not write the cache of characters: ", e
+
+    return chars, w_ch, w_ch_off
+
+def load_chars(cfg, words):
+    """Loads the char inventory and the char ids of words, using the cache if it is up to date."""
+    prefix = cfg.w_cache + '.ch'
+    stamp = file_stamp([cfg.w_dic, cfg.ch_dic])
+    if not valid_cache(prefix, stamp):
+        return build_chars_cache(cfg, words, stamp)
+
+    with codecs.open(prefix + '.chars', 'r', 'utf-8') as fd:
+        chars = fd.read().split(u'\n')
+    w_ch = np.load(prefix + '.w_ch.npy', mmap_mode='r')
+    w_ch_off = np.load(prefix + '.w_ch_off.npy', mmap_mode='r')
+
+    return chars, w_ch, w_ch_off
+
 def load_embeddings(cfg):
     #This is where we will keep embeddings data.
     cfg.data = {}
 
+    #This is where we will keep the compiled corpora.
+    cfg.corpora = {}
+
+    #Memoizes the ids of the raw tokens across batches and epochs.
+    cfg.token_cache = TokenCache(cfg, cfg.token_cache_size)
+
     #Defining some constants. Change this part if you want.
     cfg.unk = 'UNK'
     cfg.dig = 'DIGIT'
@@ -17,9 +201,7 @@ def load_embeddings(cfg):
 
     #Loads the starter word vectors.
     print "INFO: Loading word embeddings!"
-    word_vectors = np.loadtxt(cfg.w_vector, dtype=np.float32)
-    with codecs.open(cfg.w_dic, 'r', 'utf-8') as fd:
-        words = [line.strip() for line in fd]
+    words, word_vectors = load_word_vectors(cfg)
 
     #Adding constants to words and word_vectors.
     #Pad should be the last.
@@ -31,7 +213,13 @@ def load_embeddings(cfg):
     #Use xavier-uniform distribution to initialize vectors for constants.
     ep = np.sqrt(np.divide(6.0, cfg.w_em_size))
     temp_vec = np.random.uniform(low=-ep, high=ep, size=(5, cfg.w_em_size))
-    word_vectors = np.append(word_vectors, temp_vec, axis=0)
+
+    #Copy the (memory-mapped) starter vectors once, next to the constants.
+    n_vectors = word_vectors.shape[0]
+    all_vectors = np.empty((n_vectors + 5, cfg.w_em_size), dtype=np.float32)
+    all_vectors[:n_vectors] = word_vectors
+    all_vectors[n_vectors:] = temp_vec
+    word_vectors = all_vectors
 
     #Map each word to id, and vice versa.
     id_w = dict(enumerate(words))
@@ -44,16 +232,10 @@ def load_embeddings(cfg):
 
     #Finds chars from words.
     print "INFO: Loading characters!"
-    with codecs.open(cfg.ch_dic, 'r', 'utf-8') as fd:
-        chars = [line.strip() for line in fd]
-
-    for w in words:
-        for ch in list(w):
-            if ch not in chars:
-                chars.append(ch)
+    cfg.ch_pad = 'PAD'
+    chars, w_ch, w_ch_off = load_chars(cfg, words)
 
     #Pad should be the last.
-    cfg.ch_pad = 'PAD'
     chars.append(cfg.ch_pad)
 
     cfg.ch_size = len(chars)
@@ -69,6 +251,10 @@ def load_embeddings(cfg):
     cfg.data['id_ch'] = id_ch
     cfg.data['ch_id'] = ch_id
 
+    #Char ids of each word in the dictionary.
+    cfg.data['w_ch'] = w_ch
+    cfg.data['w_ch_off'] = w_ch_off
+
     #Loads the tags
     print "INFO: Loading tags!"
     tags = []
@@ -125,16 +311,16 @@ def process_word(cfg, word):
     if word in w_id:
         return w_id[word]
 
-    #Change this part for more rules to detect dates.
-    elif re.search(r'\d{4}-\d{2}-\d{2}', word):
+    #Change DATE_RE for more rules to detect dates.
+    elif DATE_RE.search(word):
         return w_id[cfg.date]
 
-    #Change this part for more rules to detect times.
-    elif re.search(r'\d+:\d+:[\d.]+', word):
+    #Change TIME_RE for more rules to detect times.
+    elif TIME_RE.search(word):
         return w_id[cfg.time]
 
     #Detecting other digits.
-    elif re.search(r'\d', word):
+    elif DIGIT_RE.search(word):
         return w_id[cfg.dig]
 
     #print "INFO: Could not find the following word and replaced it with 'UNK': ", word
@@ -161,35 +347,10 @@ def process_chars(cfg, word):
 
     return lst
 
-def load_data(cfg):
-    """ Loads train, dev or test data. """
-    #We assume that we cannot read the whole data into memory at once.
-    #We do not need the whole data, we read batches of the data.
-
-    #static batch size
-    sb_size = cfg.batch_size
-
-    #local_mode can have three values 'train', 'dev' and 'test'.
-    mode = cfg.local_mode
-
-    if mode == 'train':
-        f_raw = cfg.train_raw
-        f_ref = cfg.train_ref
-        hasY = True
+def read_sentences(f_raw, f_ref):
+    """Reads the sentences of the raw file, along with their reference lines if f_ref is given."""
+    hasY = f_ref is not None
 
-    elif mode == 'dev':
-        f_raw = cfg.dev_raw
-        f_ref = cfg.dev_ref
-        hasY = True
-
-    elif mode == 'test':
-        f_raw = cfg.test_raw
-        f_ref = None
-        hasY = False
-
-
-    batch = []
-    counter = 0
     fd_raw = codecs.open(f_raw, 'r', 'utf-8')
     if hasY: fd_ref = codecs.open(f_ref, 'r', 'utf-8')
     x_buffer = []
@@ -202,12 +363,7 @@ def load_data(cfg):
         #new sentence on blank line
         if (len(x_line) == 0):
             if len(x_buffer) > 0:
-                batch.append((x_buffer, y_buffer))
-                counter += 1
-                if counter==sb_size:
-                    yield process_batch(cfg, batch)
-                    batch = []
-                    counter = 0
+                yield x_buffer, y_buffer
             x_buffer = []
             y_buffer = []
 
@@ -219,9 +375,597 @@ def load_data(cfg):
     if hasY: fd_ref.close()
 
     #flush running buffer
-    if counter!=0 or len(x_buffer)!=0:
-        batch.append((x_buffer, y_buffer))
-        yield process_batch(cfg, batch)
+    if len(x_buffer) > 0:
+        yield x_buffer, y_buffer
+
+def encode_sentence(cfg, X, Y):
+    """
+        Maps the words of the sentence X to word, cap and char ids,
+        and its tags Y to tag ids. Y is None if there are no tags.
+        The char ids of all words are concatenated in 'ch', and 'w_len' has the number of chars of each word.
+    """
+    S = {
+        'raw_w': X,
+        'w': [],
+        'w_cap': [],
+        'ch': [],
+        'w_len': [],
+        'tag': None
+        }
+
+    for word in X:
+        word_id, cap_id, chars = cfg.token_cache.lookup(word)
+        S['w'].append(word_id)
+        S['w_cap'].append(cap_id)
+        S['ch'].extend(chars)
+        S['w_len'].append(len(chars))
+
+    #Y is the tags sequence for the sentence X.
+    if Y is not None:
+        S['tag'] = []
+        for y in Y:
+            if len(y.split('\t'))>1:
+                tag = y.split('\t')[0]
+            else:
+                tag = y
+            S['tag'].append(process_tag(cfg, tag))
+
+    return S
+
+def encode_chunk(cfg, chunk, hasY):
+    """
+        Encodes a chunk of (X, Y) sentences into flat arrays of their tokens:
+        w, w_cap, tag, ch and w_len, s_len for the number of words of each sentence,
+        and raw, raw_len for the utf-8 bytes of each sentence.
+    """
+    hits = cfg.token_cache.hits
+    misses = cfg.token_cache.misses
+
+    W = []
+    Caps = []
+    Tags = []
+    Chars = []
+    W_Len = []
+    S_Len = []
+    Raw = []
+    Raw_Len = []
+    for X, Y in chunk:
+        S = encode_sentence(cfg, X, Y if hasY else None)
+        W.extend(S['w'])
+        Caps.extend(S['w_cap'])
+        Chars.extend(S['ch'])
+        W_Len.extend(S['w_len'])
+        if hasY: Tags.extend(S['tag'])
+        S_Len.append(len(X))
+
+        raw = (u'\n'.join(X) + u'\n').encode('utf-8')
+        Raw.append(raw)
+        Raw_Len.append(len(raw))
+
+    return {
+        'w': np.array(W, dtype=np.int32),
+        'w_cap': np.array(Caps, dtype=np.int8),
+        'ch': np.array(Chars, dtype=np.int32),
+        'w_len': np.array(W_Len, dtype=np.int64),
+        's_len': np.array(S_Len, dtype=np.int64),
+        'raw': np.frombuffer(''.join(Raw), dtype=np.uint8),
+        'raw_len': np.array(Raw_Len, dtype=np.int64),
+        'tag': np.array(Tags, dtype=np.int32),
+        'hits': cfg.token_cache.hits - hits,
+        'misses': cfg.token_cache.misses - misses
+        }
+
+#The configuration of a compile worker process.
+worker_cfg = None
+
+def init_compile_worker(cfg):
+    global worker_cfg
+    worker_cfg = cfg
+    return
+
+def compile_worker(task):
+    chunk, hasY = task
+    return encode_chunk(worker_cfg, chunk, hasY)
+
+def ordered_map(pool, func, tasks, ahead):
+    """
+        Like pool.imap, the results of func on tasks in order,
+        but only ahead tasks are read and sent to the pool before their results are used;
+        pool.imap reads all the tasks at once.
+    """
+    pending = collections.deque()
+    for task in tasks:
+        pending.append(pool.apply_async(func, (task,)))
+        if len(pending) >= ahead:
+            yield pending.popleft().get()
+
+    while len(pending)!=0:
+        yield pending.popleft().get()
+
+def chunk_sentences(sentences, size):
+    """Groups the stream of sentences into chunks of size sentences."""
+    chunk = []
+    for sentence in sentences:
+        chunk.append(sentence)
+        if len(chunk)==size:
+            yield chunk
+            chunk = []
+
+    if len(chunk)!=0:
+        yield chunk
+
+class CorpusArray(object):
+    """
+        A compiled array built by appending the parts of the chunks in order.
+        With a path, the parts are written to path + '.part' as they arrive,
+        and close converts the file into the .npy file at path and memory-maps it.
+        Without a path, the parts are kept in memory.
+        An offset array starts with 0, and its parts are lengths which are accumulated.
+    """
+    def __init__(self, path, dtype, offsets=False):
+        self.path = path
+        self.dtype = dtype
+        self.offsets = offsets
+        self.size = 0
+        self.total = 0
+        self.parts = []
+        self.fd = open(path + '.part', 'wb') if path is not None else None
+        if offsets:
+            self.write(np.zeros(1, dtype=dtype))
+
+    def write(self, x):
+        if self.fd is not None:
+            self.fd.write(x.tostring())
+        else:
+            self.parts.append(x)
+        self.size += len(x)
+        return
+
+    def append(self, x):
+        x = np.asarray(x, dtype=self.dtype)
+        if self.offsets and len(x)!=0:
+            x = self.total + np.cumsum(x, dtype=self.dtype)
+            self.total = x[-1]
+        self.write(x)
+        return
+
+    def close(self):
+        if self.fd is None:
+            return np.concatenate([np.zeros(0, dtype=self.dtype)] + self.parts)
+
+        #The .npy file is the header of the array followed by the part file,
+        #copied as a stream, so the array is never in memory.
+        self.fd.close()
+        header = {
+                'descr': np.lib.format.dtype_to_descr(np.dtype(self.dtype)),
+                'fortran_order': False,
+                'shape': (self.size,)
+                }
+        with open(self.path, 'wb') as fd:
+            np.lib.format.write_array_header_1_0(fd, header)
+            with open(self.path + '.part', 'rb') as part:
+                shutil.copyfileobj(part, fd, 1<<20)
+
+        os.remove(self.path + '.part')
+        return np.load(self.path, mmap_mode='r')
+
+def compile_corpus(cfg, f_raw, f_ref, prefix=None):
+    """
+        Encodes all sentences of f_raw/f_ref into flat id arrays:
+        w, w_cap, tag: word, cap and tag ids of all tokens.
+        ch, ch_off: char ids of all tokens, where the chars of token i are ch[ch_off[i]:ch_off[i+1]].
+        s_off: the tokens of sentence j are the ones in [s_off[j], s_off[j+1]).
+        raw, raw_off: utf-8 bytes of the tokens of sentence j (each ending with a new line)
+                      are raw[raw_off[j]:raw_off[j+1]].
+        Chunks of sentences are encoded by compile_workers processes, and appended in order
+        to the files prefix.<name>.npy, which are returned memory-mapped.
+        Without a prefix, the arrays are kept in memory.
+    """
+    print "INFO: Compiling the corpus ", f_raw
+    hasY = f_ref is not None
+
+    def array(name, dtype, offsets=False):
+        path = prefix + '.' + name + '.npy' if prefix is not None else None
+        return CorpusArray(path, dtype, offsets)
+
+    #Offset arrays are built from the lengths of the parts.
+    arrays = {
+        'w': array('w', np.int32),
+        'w_cap': array('w_cap', np.int8),
+        'ch': array('ch', np.int32),
+        'ch_off': array('ch_off', np.int64, True),
+        's_off': array('s_off', np.int64, True),
+        'raw': array('raw', np.uint8),
+        'raw_off': array('raw_off', np.int64, True)
+        }
+    if hasY: arrays['tag'] = array('tag', np.int32)
+    sources = {'ch_off': 'w_len', 's_off': 's_len', 'raw_off': 'raw_len'}
+
+    #Chunks are read and encoded as the workers need them,
+    #so only a few chunks are in memory at once.
+    chunks = chunk_sentences(read_sentences(f_raw, f_ref), 1000)
+    pool = None
+    if cfg.compile_workers > 0:
+        #Workers are forked with a copy of cfg.
+        pool = multiprocessing.Pool(cfg.compile_workers, init_compile_worker, (cfg,))
+        parts = ordered_map(pool, compile_worker, ((chunk, hasY) for chunk in chunks), 2 * cfg.compile_workers)
+
+    else:
+        parts = (encode_chunk(cfg, chunk, hasY) for chunk in chunks)
+
+    try:
+        for part in parts:
+            for name in arrays:
+                arrays[name].append(part[sources.get(name, name)])
+
+            cfg.token_cache.hits += part['hits']
+            cfg.token_cache.misses += part['misses']
+
+    finally:
+        #All the results are used, or the compiling failed.
+        if pool is not None:
+            pool.terminate()
+            pool.join()
+
+    print "INFO: Token cache hit rate:{:.3f}".format(cfg.token_cache.hit_rate())
+
+    C = {'tag': None}
+    for name in arrays:
+        C[name] = arrays[name].close()
+
+    return C
+
+def load_corpus(cfg, f_raw, f_ref):
+    """
+        Returns the compiled corpus of f_raw/f_ref as memory-mapped arrays.
+        The corpus is compiled once into files next to f_raw,
+        and compiled again whenever the data or the dictionaries change.
+    """
+    if f_raw in cfg.corpora:
+        return cfg.corpora[f_raw]
+
+    hasY = f_ref is not None
+    prefix = f_raw + '.compiled'
+    names = ['w', 'w_cap', 'ch', 'ch_off', 's_off', 'raw', 'raw_off']
+    if hasY: names.append('tag')
+
+    sources = [f_raw, cfg.w_dic, cfg.ch_dic, cfg.tag_dic]
+    if hasY: sources.append(f_ref)
+    stamp = file_stamp(sources)
+
+    if valid_cache(prefix, stamp):
+        C = {'tag': None}
+        for name in names:
+            C[name] = np.load(prefix + '.' + name + '.npy', mmap_mode='r')
+
+    else:
+        try:
+            C = compile_corpus(cfg, f_raw, f_ref, prefix)
+            save_cache_stamp(prefix, stamp)
+
+        except (IOError, OSError) as e:
+            print "INFO: Could not write the compiled corpus: ", e
+            C = compile_corpus(cfg, f_raw, f_ref)
+
+    cfg.corpora[f_raw] = C
+    return C
+
+def compiled_sentence(C, j):
+    """Slices the sentence j out of the compiled corpus C."""
+    start = C['s_off'][j]
+    end = C['s_off'][j+1]
+    ch_off = C['ch_off'][start:end+1]
+    raw = C['raw'][C['raw_off'][j]:C['raw_off'][j+1]].tostring().decode('utf-8')
+    S = {
+        'raw_w': raw.split(u'\n')[:-1],
+        'w': C['w'][start:end],
+        'w_cap': C['w_cap'][start:end],
+        'ch': C['ch'][ch_off[0]:ch_off[-1]],
+        'w_len': np.diff(ch_off),
+        'tag': None
+        }
+
+    if C['tag'] is not None:
+        S['tag'] = C['tag'][start:end]
+
+    return S
+
+def compile_data(cfg):
+    """Compiles the train and dev sets ahead of training."""
+    for f_raw, f_ref in [(cfg.train_raw, cfg.train_ref), (cfg.dev_raw, cfg.dev_ref)]:
+        C = load_corpus(cfg, f_raw, f_ref)
+        print "INFO: {} has {} sentences and {} tokens.".format(f_raw, len(C['s_off'])-1, len(C['w']))
+
+    return
+
+def sentence_lengths(C):
+    """Returns the number of words and the longest word length of each sentence in the compiled corpus C."""
+    s_off = np.asarray(C['s_off'])
+    w_len = np.diff(np.asarray(C['ch_off']))
+    s_len = np.diff(s_off)
+    s_max_w_len = np.maximum.reduceat(w_len, s_off[:-1])
+    return s_len, s_max_w_len
+
+def fits_batch(cfg, n, max_s_len, max_w_len):
+    """
+        Checks whether n sentences, padded to max_s_len words of max_w_len chars, fit in one batch.
+        A batch has at most batch_size sentences, batch_tokens padded words
+        and batch_chars padded chars (None disables a budget).
+    """
+    if n > cfg.batch_size:
+        return False
+
+    if cfg.batch_tokens is not None and n * max_s_len > cfg.batch_tokens:
+        return False
+
+    if cfg.batch_chars is not None and n * max_s_len * max_w_len > cfg.batch_chars:
+        return False
+
+    return True
+
+def budget_batches(cfg, order, s_len, s_max_w_len):
+    """
+        Cuts the sentences in order into consecutive batches that fit in the batch budgets.
+        A sentence which exceeds the budgets on its own makes a batch of one.
+    """
+    batches = []
+    start = 0
+    max_s_len = 0
+    max_w_len = 0
+    for i, (l, w) in enumerate(izip(s_len[order].tolist(), s_max_w_len[order].tolist())):
+        if i > start and not fits_batch(cfg, i - start + 1, max(max_s_len, l), max(max_w_len, w)):
+            batches.append(order[start:i])
+            start = i
+            max_s_len = 0
+            max_w_len = 0
+
+        max_s_len = max(max_s_len, l)
+        max_w_len = max(max_w_len, w)
+
+    if start < len(order):
+        batches.append(order[start:])
+
+    return batches
+
+def bucket_batches(cfg, s_len, s_max_w_len, rng):
+    """
+        Groups sentences of similar length into batches.
+        Sentences are shuffled and split into pools of bucket_pool batches.
+        Each pool is sorted by sentence length (then by longest word),
+        and cut into batches within the batch budgets. Finally, all batches are shuffled.
+        rng is the numpy RandomState of the epoch.
+    """
+    pool_size = cfg.batch_size * cfg.bucket_pool
+
+    order = rng.permutation(len(s_len))
+    batches = []
+    for start in range(0, len(order), pool_size):
+        pool = order[start:start + pool_size]
+        pool = pool[np.lexsort((s_max_w_len[pool], s_len[pool]))]
+        batches.extend(budget_batches(cfg, pool, s_len, s_max_w_len))
+
+    return [batches[i] for i in rng.permutation(len(batches))]
+
+def padding_ratio(batches, s_len, s_max_w_len):
+    """
+        Returns the ratio of pad words and pad chars if sentences are batched as batches.
+        Chars are counted as if each word of a sentence were as long as its longest word.
+    """
+    pad_w = 0.0
+    pad_ch = 0.0
+    total_w = 0.0
+    total_ch = 0.0
+    for batch in batches:
+        max_s_len = s_len[batch].max()
+        max_w_len = s_max_w_len[batch].max()
+        pad_w += len(batch) * max_s_len - s_len[batch].sum()
+        total_w += len(batch) * max_s_len
+        pad_ch += len(batch) * max_s_len * max_w_len - (s_len[batch] * s_max_w_len[batch]).sum()
+        total_ch += len(batch) * max_s_len * max_w_len
+
+    return pad_w / total_w, pad_ch / total_ch
+
+def batch_plans(cfg):
+    """
+        Yields what each batch of the train, dev or test data is made of:
+        (C, sentence indices) for compiled data, or (None, raw sentences) otherwise.
+        make_batch builds the batch of a plan.
+    """
+    #We assume that we cannot read the whole data into memory at once.
+    #We do not need the whole data, we read batches of the data.
+
+    #local_mode can have three values 'train', 'dev' and 'test'.
+    mode = cfg.local_mode
+
+    if mode == 'train':
+        f_raw = cfg.train_raw
+        f_ref = cfg.train_ref
+        hasY = True
+
+        #The order of each epoch only depends on the seed and the epoch number.
+        rng = np.random.RandomState(cfg.seed + cfg.epoch)
+
+    elif mode == 'dev':
+        f_raw = cfg.dev_raw
+        f_ref = cfg.dev_ref
+        hasY = True
+
+    elif mode == 'test':
+        f_raw = cfg.test_raw
+        f_ref = None
+        hasY = False
+
+    #Labeled data is read from its compiled, memory-mapped version.
+    if hasY and cfg.compile_corpus:
+        C = load_corpus(cfg, f_raw, f_ref)
+        s_len, s_max_w_len = sentence_lengths(C)
+        batches = budget_batches(cfg, np.arange(len(s_len)), s_len, s_max_w_len)
+
+        if mode=='train' and cfg.bucketing:
+            file_w, file_ch = padding_ratio(batches, s_len, s_max_w_len)
+            batches = bucket_batches(cfg, s_len, s_max_w_len, rng)
+            bucket_w, bucket_ch = padding_ratio(batches, s_len, s_max_w_len)
+            print "INFO: Padding ratio of words:{:.3f} -> {:.3f} | of chars:{:.3f} -> {:.3f}".format(
+                                                file_w,
+                                                bucket_w,
+                                                file_ch,
+                                                bucket_ch
+                                                )
+
+        elif mode=='train':
+            batches = [batches[i] for i in rng.permutation(len(batches))]
+
+        for batch in batches:
+            yield C, batch
+
+        return
+
+    sentences = read_sentences(f_raw, f_ref)
+
+    #Raw training data is streamed through a bounded shuffle buffer.
+    if mode=='train':
+        sentences = shuffle_stream(sentences, cfg.shuffle_buffer, rng)
+
+    for plan in raw_batch_plans(cfg, sentences):
+        yield plan
+
+def shuffle_stream(items, size, rng):
+    """Shuffles a stream of items while keeping at most size items in memory."""
+    buffer = []
+    for item in items:
+        if len(buffer) < size:
+            buffer.append(item)
+            continue
+
+        #Emit a random buffered item, and keep the new one in its place.
+        i = rng.randint(size)
+        yield buffer[i]
+        buffer[i] = item
+
+    for i in rng.permutation(len(buffer)):
+        yield buffer[i]
+
+def raw_batch_plans(cfg, sentences):
+    """Yields the raw sentences of each batch, within the batch budgets, in the order of the sentences."""
+    batch = []
+    max_s_len = 0
+    max_w_len = 0
+    for X, Y in sentences:
+        s_len = len(X)
+        w_len = max(len(x) for x in X)
+        if len(batch)!=0 and not fits_batch(cfg, len(batch) + 1, max(max_s_len, s_len), max(max_w_len, w_len)):
+            yield None, batch
+            batch = []
+            max_s_len = 0
+            max_w_len = 0
+
+        batch.append((X, Y))
+        max_s_len = max(max_s_len, s_len)
+        max_w_len = max(max_w_len, w_len)
+
+    #flush running batch
+    if len(batch)!=0:
+        yield None, batch
+
+def make_batch(cfg, plan):
+    """Builds the batch of a plan from batch_plans."""
+    C, sentences = plan
+    if C is not None:
+        return build_batch(cfg, [compiled_sentence(C, j) for j in sentences])
+
+    return process_batch(cfg, sentences)
+
+def load_data(cfg):
+    """ Loads train, dev or test data. """
+    for plan in batch_plans(cfg):
+        yield make_batch(cfg, plan)
+
+def prefetch(items, work, depth, workers):
+    """
+        Applies work to the items in background threads, and yields the results in order.
+        At most depth items are in flight: queued, being processed or ready for the consumer.
+        With 0 workers, work is applied in the caller's thread.
+    """
+    if workers==0:
+        for item in items:
+            yield work(item)
+
+        return
+
+    slots = threading.Semaphore(depth)
+    tasks = Queue.Queue()
+    done = Queue.Queue()
+    stop = threading.Event()
+
+    def feed():
+        try:
+            for index, item in enumerate(items):
+                slots.acquire()
+                if stop.is_set(): break
+                tasks.put((index, item))
+
+        except Exception:
+            done.put((None, None, sys.exc_info()))
+
+        #One end signal for each worker.
+        for _ in range(workers):
+            tasks.put(None)
+
+    def run():
+        while True:
+            task = tasks.get()
+            if task is None:
+                done.put(None)
+                return
+
+            #Skip the remaining tasks if the consumer has stopped.
+            if stop.is_set(): continue
+
+            index, item = task
+            try:
+                done.put((index, work(item), None))
+            except Exception:
+                done.put((index, None, sys.exc_info()))
+
+    threads = [threading.Thread(target=feed)]
+    threads.extend([threading.Thread(target=run) for _ in range(workers)])
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+
+    #Results may finish out of order, ready keeps them until their turn.
+    ready = {}
+    next_index = 0
+    finished = 0
+    try:
+        while True:
+            if next_index in ready:
+                result = ready.pop(next_index)
+                next_index += 1
+                slots.release()
+                yield result
+                continue
+
+            if finished==workers:
+                break
+
+            message = done.get()
+            if message is None:
+                finished += 1
+                continue
+
+            index, result, exc_info = message
+            if exc_info is not None:
+                raise exc_info[0], exc_info[1], exc_info[2]
+
+            ready[index] = result
+
+    finally:
+        #Unblock the feeder if the consumer stops early, and wait for the workers.
+        stop.set()
+        slots.release()
+        for thread in threads:
+            thread.join()
 
 def process_batch(cfg, batch):
     mode = cfg.local_mode
@@ -229,95 +973,76 @@ def process_batch(cfg, batch):
     hasY = True
     if mode=='test': hasY = False
 
-    Raw_Words = []
-    Word_Ids = []
-    Cap_Ids = []
-    Word_to_Chars = {}
-    Tag_Ids = []
-    S_Lens = []
-
-    raw_words = []
-    word_ids = []
-    cap_ids = []
-    tag_ids = []
+    sentences = []
     for (X, Y) in batch:
         #X is one sentence.
         if len(X)==0 and len(Y)==0: continue
 
-        for x in X:
-            word = x
-            raw_words.append(word)
-            word_id = process_word(cfg, word)
-            word_ids.append(word_id)
-            if word_id not in Word_to_Chars:
-                Word_to_Chars[word_id] = process_chars(cfg, word)
-            cap_ids.append(capalize_word(word))
-
-        #finished one sentence, now add inner lists to parent lists.
-        Raw_Words.append(raw_words)
-        Word_Ids.append(word_ids)
-        Cap_Ids.append(cap_ids)
-        S_Lens.append(len(X))
-
-        #Reset inner lists for the next sentence.
-        raw_words = []
-        word_ids = []
-        cap_ids = []
-
-        #Y is the tags sequence for the sentence X.
-        for y in Y:
-            if len(y.split('\t'))>1:
-                tag = y.split('\t')[0]
-            else:
-                tag = y
-            tag_ids.append(process_tag(cfg, tag))
+        sentences.append(encode_sentence(cfg, X, Y if hasY else None))
 
-        Tag_Ids.append(tag_ids)
+    return build_batch(cfg, sentences)
 
-        #Reset inner list for the next sequence.
-        tag_ids = []
+def build_batch(cfg, sentences):
+    """
+        Builds the padded batch of the encoded sentences.
+        All id matrices are written into preallocated int64 arrays,
+        so they can be wrapped by torch tensors without copying.
+    """
+    mode = cfg.local_mode
 
+    hasY = True
+    if mode=='test': hasY = False
 
-    Char_Ids = []
-    W_Len = []
-    index = 0
-    for word_id, chars in Word_to_Chars.iteritems():
-        Char_Ids.append(chars)
-        W_Len.append(len(chars))
-        Word_to_Chars[word_id] = index
-        index += 1
+    #Set dynamic batch size
+    d_batch_size = len(sentences)
 
-    #Word_Chars has a new id for each word of the sentence in the batch.
-    #This new id will map the word to its chars list in Char_Ids.
-    #This will be used to map word to its chars.
-    Word_Chars = []
-    for sentence in Word_Ids:
-        word_chars_id = []
-        for word_id in sentence:
-            word_chars_id.append(Word_to_Chars[word_id])
+    S_Lens = np.array([len(S['w']) for S in sentences], dtype=np.int64)
+    max_s_len = int(S_Lens.max())
 
-        Word_Chars.append(word_chars_id)
+    #Creating mask for word sequences
+    W_Mask = (np.arange(max_s_len).reshape(1, -1) < S_Lens.reshape(-1, 1)).astype(np.float32)
+    valid = W_Mask.astype(np.bool_)
 
+    #Tokens of the batch in row-major order, which is the order of valid positions.
+    flat_w = np.concatenate([S['w'] for S in sentences]).astype(np.int64)
+    flat_cap = np.concatenate([S['w_cap'] for S in sentences])
+    flat_ch = np.concatenate([S['ch'] for S in sentences]).astype(np.int64)
+    flat_w_len = np.concatenate([S['w_len'] for S in sentences]).astype(np.int64)
+    flat_ch_off = np.cumsum(flat_w_len) - flat_w_len
 
-    #Set dynamic batch size
-    d_batch_size = len(S_Lens)
+    Word_Ids = np.full((d_batch_size, max_s_len), cfg.w_pad_id, dtype=np.int64)
+    Word_Ids[valid] = flat_w
 
-    #Creating reversed char sequences
-    Rev_Char_Ids = []
-    for i in range(len(Char_Ids)):
-        lst = list(reversed(Char_Ids[i]))
-        Rev_Char_Ids.append(lst)
+    Cap_Ids = np.full((d_batch_size, max_s_len), cfg.cap_pad_id, dtype=np.int64)
+    Cap_Ids[valid] = flat_cap
 
-    #Creating mask for word sequences
-    W_Mask = []
-    for each in S_Lens:
-        lst = [1.0] * each
-        W_Mask.append(lst)
+    if hasY:
+        Tag_Ids = np.full((d_batch_size, max_s_len), cfg.tag_pad_id, dtype=np.int64)
+        Tag_Ids[valid] = np.concatenate([S['tag'] for S in sentences])
+
+    #Each distinct word id of the batch gets one chars list, from its first occurrence.
+    #Word_Chars maps each word of the sentences to its chars list in Char_Ids.
+    uniq_w, first, inverse = np.unique(flat_w, return_index=True, return_inverse=True)
+    Word_Chars = np.zeros((d_batch_size, max_s_len), dtype=np.int64)
+    Word_Chars[valid] = inverse
+
+    W_Len = flat_w_len[first]
+    max_w_len = int(W_Len.max())
+    steps = np.arange(max_w_len).reshape(1, -1)
+    ch_valid = steps < W_Len.reshape(-1, 1)
+    starts = flat_ch_off[first].reshape(-1, 1)
+
+    Char_Ids = np.full((len(uniq_w), max_w_len), cfg.ch_pad_id, dtype=np.int64)
+    Char_Ids[ch_valid] = flat_ch[(starts + steps)[ch_valid]]
+
+    #Raw words are padded with w_pad.
+    Raw_Words = []
+    for S in sentences:
+        Raw_Words.append(list(S['raw_w']) + [cfg.w_pad] * (max_s_len - len(S['raw_w'])))
 
     #The processed batch is now a dictionary.
     B = {
         'ch': Char_Ids,
-        'rev_ch': Rev_Char_Ids,
         'w_len': W_Len,
         'w_chs': Word_Chars,
         'w': Word_Ids,
@@ -325,7 +1050,9 @@ def process_batch(cfg, batch):
         'w_cap': Cap_Ids,
         's_len': S_Lens,
         'raw_w': Raw_Words,
-        'd_batch_size': d_batch_size
+        'd_batch_size': d_batch_size,
+        'max_s_len': max_s_len,
+        'max_w_len': max_w_len
         }
 
     if hasY:
@@ -333,54 +1060,4 @@ def process_batch(cfg, batch):
     else:
         B['tag'] = None
 
-    pad(cfg, B)
-
     return B
-
-def pad(cfg, B):
-    #Dynamically select max sentence and word length for the current batch.
-    B['max_s_len'] = max(B['s_len'])
-    B['max_w_len'] = max(B['w_len'])
-
-    #Pad w with w_pad_id
-    for sentence in B['w']:
-        pad_lst = [cfg.w_pad_id] * (B['max_s_len']-len(sentence))
-        sentence.extend(pad_lst)
-
-    #Pad w with w_pad
-    for sentence in B['raw_w']:
-        pad_lst = [cfg.w_pad] * (B['max_s_len']-len(sentence))
-        sentence.extend(pad_lst)
-
-    #Pad w_cap with cap_pad_id
-    for sentence in B['w_cap']:
-        pad_lst = [cfg.cap_pad_id] * (B['max_s_len']-len(sentence))
-        sentence.extend(pad_lst)
-
-    #Pad tag with tag_pad_id
-    if B['tag'] is not None:
-        for sequence in B['tag']:
-            pad_lst = [cfg.tag_pad_id] * (B['max_s_len']-len(sequence))
-            sequence.extend(pad_lst)
-
-    #Pad ch with ch_pad_id
-    for word in B['ch']:
-        pad_lst = [cfg.ch_pad_id] * (B['max_w_len']-len(word))
-        word.extend(pad_lst)
-
-    #Pad rev_ch with ch_pad_id
-    for word in B['rev_ch']:
-        pad_lst = [cfg.ch_pad_id] * (B['max_w_len']-len(word))
-        word.extend(pad_lst)
-
-    #Pad w_chs with 0
-    for sentence in B['w_chs']:
-        pad_lst = [0] * (B['max_s_len']-len(sentence))
-        sentence.extend(pad_lst)
-
-    #Pad w_mask with 0.0
-    for sentence in B['w_mask']:
-        pad_lst = [0.0] * (B['max_s_len']-len(sentence))
-        sentence.extend(pad_lst)
-
-    return
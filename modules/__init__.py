@@ -1 +1 @@
-__all__ = ["feature", "encoder", "indp", "mldecoder", "rltrain", "crf"]
+__all__ = ["feature", "encoder", "indp", "mldecoder", "rltrain", "crf", "graph", "util"]
@@ -4,9 +4,94 @@ import numpy as np
 import torch.nn as nn
 from torch.nn import init
 from torch.autograd import Variable
+from modules.util import length_order
 
 hasCuda = torch.cuda.is_available()
 
+def viterbi(emissions, mask, start_transitions, end_transitions, transitions):
+    # type: (Tensor, Tensor, Tensor, Tensor, Tensor) -> Tensor
+    """
+    Batched Viterbi decoding of the emission scores (batch size, max length, tags).
+    At pad steps (mask == 0), the back-pointers keep the previous tag.
+    Returns the best tags of size (batch size, max length).
+    It is written in the TorchScript subset, see modules/graph.py.
+    """
+    batch_size = emissions.size(0)
+    max_s_len = emissions.size(1)
+    tag_size = emissions.size(2)
+
+    score = start_transitions.unsqueeze(0) + emissions[:, 0]
+    same_tags = torch.arange(tag_size, dtype=torch.long, device=emissions.device).unsqueeze(0).expand(batch_size, tag_size)
+    history = torch.zeros([max_s_len, batch_size, tag_size], dtype=torch.long, device=emissions.device)
+    for i in range(1, max_s_len):
+        #(batch size, current tag, next tag)
+        next_score = score.unsqueeze(2) + transitions.unsqueeze(0) + emissions[:, i].unsqueeze(1)
+        best_score, best_path = next_score.max(1)
+        valid = mask[:, i].unsqueeze(1) > 0
+        score = torch.where(valid, best_score, score)
+        history[i] = torch.where(valid, best_path, same_tags)
+
+    score = score + end_transitions.unsqueeze(0)
+    _, best_last_tag = score.max(1)
+
+    #Trace back the best tags from the last step.
+    preds = torch.zeros([batch_size, max_s_len], dtype=torch.long, device=emissions.device)
+    preds[:, max_s_len - 1] = best_last_tag
+    for j in range(1, max_s_len):
+        i = max_s_len - j
+        preds[:, i - 1] = history[i].gather(1, preds[:, i].unsqueeze(1)).squeeze(1)
+
+    return preds
+
+def lattice_transitions(transitions, prev_tags, cur_tags):
+    # type: (Tensor, Tensor, Tensor) -> Tensor
+    """
+    Transition scores between the kept tags of two adjacent steps:
+    prev_tags and cur_tags are (batch size, k) tag ids, the result is (batch size, k, k).
+    """
+    tag_size = transitions.size(0)
+    batch_size = prev_tags.size(0)
+    k = prev_tags.size(1)
+    #transitions[i, j] is at i * tag_size + j in the flat matrix.
+    pair_ids = prev_tags.unsqueeze(2) * tag_size + cur_tags.unsqueeze(1)
+    return transitions.view(-1).index_select(0, pair_ids.view(-1)).view(batch_size, k, k)
+
+def pruned_viterbi(emissions, tag_ids, mask, start_transitions, end_transitions, transitions):
+    # type: (Tensor, Tensor, Tensor, Tensor, Tensor, Tensor) -> Tensor
+    """
+    Batched Viterbi decoding over a pruned lattice: at each step, only the k tags
+    of tag_ids (batch size, max length, k) are kept, with their emission scores in emissions.
+    Returns the best tags of size (batch size, max length).
+    """
+    batch_size = emissions.size(0)
+    max_s_len = emissions.size(1)
+    k = emissions.size(2)
+
+    score = start_transitions.index_select(0, tag_ids[:, 0].contiguous().view(-1)).view(batch_size, k) + emissions[:, 0]
+    #Kept tags of the last valid step.
+    last_tags = tag_ids[:, 0]
+    same_tags = torch.arange(k, dtype=torch.long, device=emissions.device).unsqueeze(0).expand(batch_size, k)
+    history = torch.zeros([max_s_len, batch_size, k], dtype=torch.long, device=emissions.device)
+    for i in range(1, max_s_len):
+        next_score = score.unsqueeze(2) + lattice_transitions(transitions, tag_ids[:, i-1], tag_ids[:, i]) + emissions[:, i].unsqueeze(1)
+        best_score, best_path = next_score.max(1)
+        valid = mask[:, i].unsqueeze(1) > 0
+        score = torch.where(valid, best_score, score)
+        history[i] = torch.where(valid, best_path, same_tags)
+        last_tags = torch.where(valid, tag_ids[:, i], last_tags)
+
+    score = score + end_transitions.index_select(0, last_tags.contiguous().view(-1)).view(batch_size, k)
+    _, best_last = score.max(1)
+
+    #Trace back the best positions in the lattice, then map them to tags.
+    best = torch.zeros([batch_size, max_s_len], dtype=torch.long, device=emissions.device)
+    best[:, max_s_len - 1] = best_last
+    for j in range(1, max_s_len):
+        i = max_s_len - j
+        best[:, i - 1] = history[i].gather(1, best[:, i].unsqueeze(1)).squeeze(1)
+
+    return tag_ids.gather(2, best.unsqueeze(2)).squeeze(2)
+
 class CRF(nn.Module):
     """
     This module uses linear-chain CRF for training, and Viterbi algorithm for decoding.
@@ -50,34 +135,30 @@ class CRF(nn.Module):
 
     def numerator_score(self, scores):
         cfg = self.cfg
-        emissions = scores.permute(1,0,2)
 
         w_mask = Variable(cfg.B['w_mask'].cuda()) if hasCuda else Variable(cfg.B['w_mask'])
         tag = Variable(cfg.B['tag'].cuda()) if hasCuda else Variable(cfg.B['tag'])
+        s_len = Variable(cfg.B['s_len'].cuda()) if hasCuda else Variable(cfg.B['s_len'])
 
-        tags = tag.permute(1,0)
-        mask = w_mask.permute(1,0)
+        #The scores of the gold path are gathered for all the steps at once.
+        #Emission scores of the gold tags, (batch_size, max_s_len)
+        emission_scores = scores.gather(2, tag.unsqueeze(2)).squeeze(2)
 
-        #numerator score
-        num_score = self.start_transitions[tags[0]]
-        for i in range(cfg.max_s_len-1):
-            cur_tag, next_tag = tags[i], tags[i+1]
-            #Emission score for current tag
-            num_score += emissions[i].gather(1, cur_tag.contiguous().view(-1, 1)).squeeze(1) * mask[i]
-            #Transition score to next tag
-            transition_score = self.transitions[cur_tag, next_tag]
-            #Only add transition score if the next tag is not masked (mask == 1)
-            num_score += transition_score * mask[i+1]
+        #Transition scores between adjacent gold tags, (batch_size, max_s_len-1)
+        #where transitions[i, j] is at i * tag_size + j in the flat matrix.
+        pair_ids = tag[:, :-1] * cfg.tag_size + tag[:, 1:]
+        transition_scores = self.transitions.view(-1).index_select(0, pair_ids.contiguous().view(-1))
+        transition_scores = transition_scores.view(cfg.d_batch_size, cfg.max_s_len-1)
 
-        s_len = Variable(cfg.B['s_len'].cuda()) if hasCuda else Variable(cfg.B['s_len'])
         last_tag_indices = s_len - 1
         last_tags = tag.gather(1, last_tag_indices.view(-1, 1)).squeeze(1)
 
-        #End transition score
-        num_score += self.end_transitions[last_tags]
-
-        #Emission score for the last tag (time step), if mask is valid (mask == 1)
-        num_score += emissions[-1].gather(1, last_tags.view(-1, 1)).squeeze(1) * mask[-1]
+        #Start and end transitions, emissions of the valid steps (mask == 1),
+        #and transitions into the valid steps.
+        num_score = self.start_transitions.index_select(0, tag[:, 0])
+        num_score = num_score + torch.sum(emission_scores * w_mask, dim=1)
+        num_score = num_score + torch.sum(transition_scores * w_mask[:, 1:], dim=1)
+        num_score = num_score + self.end_transitions.index_select(0, last_tags)
 
         #numerator score
         return num_score
@@ -85,43 +166,108 @@ class CRF(nn.Module):
     def partition_score(self, scores):
         #http://www.cs.columbia.edu/~mcollins/fb.pdf
         cfg = self.cfg
-        emissions = scores.permute(1,0,2)
 
-        w_mask = Variable(cfg.B['w_mask'].cuda()) if hasCuda else Variable(cfg.B['w_mask'])
-        mask = w_mask.permute(1,0)
+        #Sentences are sorted by length, and the recursion only runs
+        #over the sentences which have not ended (the first active[i] ones).
+        order, unorder, active = length_order(cfg)
+        emissions = scores.index_select(0, order).permute(1,0,2)
 
         #Start transition score and first emission
         log_prob = self.start_transitions.view(1, -1) + emissions[0]
         #Here, log_prob has size (batch_size, num_tags) where for each batch,
         #the j-th column stores the log probability that the current timestep has tag j
 
+        #Final scores of the ended sentences, with their end transition score.
+        ended = []
         for i in range(1, cfg.max_s_len):
+            n = active[i]
+            if n < log_prob.size(0):
+                ended.append(log_prob[n:] + self.end_transitions.view(1, -1))
+                log_prob = log_prob[:n]
+
             #Broadcast log_prob over all possible next tags
-            broadcast_log_prob = log_prob.unsqueeze(2)  # (batch_size, num_tags, 1)
+            broadcast_log_prob = log_prob.unsqueeze(2)  # (n, num_tags, 1)
             #Broadcast transition score over all instances in the batch
             broadcast_transitions = self.transitions.unsqueeze(0)  # (1, num_tags, num_tags)
             #Broadcast emission score over all possible current tags
-            broadcast_emissions = emissions[i].unsqueeze(1)  # (batch_size, 1, num_tags)
+            broadcast_emissions = emissions[i][:n].unsqueeze(1)  # (n, 1, num_tags)
             #Sum current log probability, transition, and emission scores
-            score = broadcast_log_prob + broadcast_transitions + broadcast_emissions  #(batch_size, num_tags, num_tags)
+            score = broadcast_log_prob + broadcast_transitions + broadcast_emissions  #(n, num_tags, num_tags)
             #Sum over all possible current tags, but we're in log prob space, so a sum
             #becomes a log-sum-exp
-            score = self.log_sum_exp(score, 1)  # (batch_size, num_tags)
-            #Set log_prob to the score if this timestep is valid (mask == 1), otherwise
-            #leave it alone
-            log_prob = score * mask[i].unsqueeze(1) + log_prob * (1.0 - mask[i]).unsqueeze(1)
+            log_prob = self.log_sum_exp(score, 1)  # (n, num_tags)
 
         #End transition score
-        log_prob += self.end_transitions.view(1, -1)
+        ended.append(log_prob + self.end_transitions.view(1, -1))
+
+        #The longest sentences ended last.
+        log_prob = torch.cat(ended[::-1], 0).index_select(0, unorder)
 
         # Sum (log-sum-exp) over all possible tags
         return self.log_sum_exp(log_prob, 1)  # (batch_size,)
 
+    def prune(self, scores):
+        """
+        Keeps the top k tags of each step by emission score (k = cfg.crf_top_k).
+        In training, the gold tags are always kept, so the gold path is in the lattice.
+        Returns the kept tag ids and their emission scores, both of size (batch_size, max_s_len, k).
+        """
+        cfg = self.cfg
+        k = min(cfg.crf_top_k, cfg.tag_size)
+        ranks = scores.data.clone()
+        if self.training:
+            tag = cfg.B['tag'].cuda() if hasCuda else cfg.B['tag']
+            ranks.scatter_(2, tag.unsqueeze(2), float('inf'))
+
+        _, tag_ids = torch.topk(ranks, k, dim=2, largest=True, sorted=False)
+        tag_ids = Variable(tag_ids)
+        return tag_ids, scores.gather(2, tag_ids)
+
+    def pruned_partition_score(self, scores):
+        """The partition score over the lattice of the top k tags of each step."""
+        cfg = self.cfg
+        tag_ids, top_scores = self.prune(scores)
+        k = tag_ids.size(2)
+
+        #As in partition_score, only the sentences which have not ended are updated.
+        order, unorder, active = length_order(cfg)
+        emissions = top_scores.index_select(0, order).permute(1,0,2)
+        tags = tag_ids.index_select(0, order).permute(1,0,2)
+
+        #Start transition score and first emission, (batch_size, k)
+        log_prob = self.start_transitions.index_select(0, tags[0].contiguous().view(-1)).view(-1, k) + emissions[0]
+
+        ended = []
+        for i in range(1, cfg.max_s_len):
+            n = active[i]
+            m = log_prob.size(0)
+            if n < m:
+                #End transition score of the kept tags of the last step.
+                end_transitions = self.end_transitions.index_select(0, tags[i-1][n:m].contiguous().view(-1)).view(-1, k)
+                ended.append(log_prob[n:] + end_transitions)
+                log_prob = log_prob[:n]
+
+            #(n, k, k) instead of (n, num_tags, num_tags)
+            transitions = lattice_transitions(self.transitions, tags[i-1][:n], tags[i][:n])
+            score = log_prob.unsqueeze(2) + transitions + emissions[i][:n].unsqueeze(1)
+            log_prob = self.log_sum_exp(score, 1)
+
+        n = log_prob.size(0)
+        end_transitions = self.end_transitions.index_select(0, tags[-1][:n].contiguous().view(-1)).view(-1, k)
+        ended.append(log_prob + end_transitions)
+
+        log_prob = torch.cat(ended[::-1], 0).index_select(0, unorder)
+        return self.log_sum_exp(log_prob, 1)
+
     def forward(self, H):
+        cfg = self.cfg
         #scores are emission scores for each tag at each step.
         scores = self.affine(H)
         numerator_score = self.numerator_score(scores)
-        log_Z = self.partition_score(scores)
+        if cfg.crf_top_k is not None:
+            log_Z = self.pruned_partition_score(scores)
+        else:
+            log_Z = self.partition_score(scores)
         crf_log_likelihood = numerator_score - log_Z
         return crf_log_likelihood
 
@@ -134,64 +280,30 @@ class CRF(nn.Module):
 
         #scores are emission scores for each tag at each step.
         scores = self.affine(H)
-        s_len = Variable(cfg.B['s_len'].cuda()) if hasCuda else Variable(cfg.B['s_len'])
+        w_mask = Variable(cfg.B['w_mask'].cuda()) if hasCuda else Variable(cfg.B['w_mask'])
 
-        emissions = scores.data
-        seq_length = s_len.data
-
-        best_tags = []
-        for i in range(cfg.d_batch_size):
-            emission = emissions[i]
-            seq_length_i = seq_length[i]
-            best_tags.append(self.viterbi_decode(emission[0:seq_length_i]))
-
-        return best_tags
-
-    def viterbi_decode(self, emission):
-        seq_length = emission.size(0)
-
-        #Start transition
-        viterbi_score = self.start_transitions.data + emission[0]
-        viterbi_path = []
-        #Here, viterbi_score has shape of (num_tags,) where value at index i stores
-        #the score of the best tag sequence so far that ends with tag i
-        #viterbi_path saves where the best tags candidate transitioned from; this is used
-        #when we trace back the best tag sequence
-
-        #Viterbi algorithm recursive case: we compute the score of the best tag sequence
-        #for every possible next tag
-        for i in range(1, seq_length):
-            #Broadcast viterbi score for every possible next tag
-            broadcast_score = viterbi_score.view(-1, 1)
-            #Broadcast emission score for every possible current tag
-            broadcast_emission = emission[i].view(1, -1)
-            #Compute the score matrix of shape (num_tags, num_tags) where each entry at
-            #row i and column j stores the score of transitioning from tag i to tag j
-            #and emitting
-            score = broadcast_score + self.transitions.data + broadcast_emission
-            #Find the maximum score over all possible current tag
-            best_score, best_path = score.max(0)  # (num_tags,)
-            #Save the score and the path
-            viterbi_score = best_score
-            viterbi_path.append(best_path)
-
-        #End transition
-        viterbi_score += self.end_transitions.data
-
-        #Find the tag which maximizes the score at the last timestep; this is our best tag
-        #for the last timestep
-        _, best_last_tag = viterbi_score.max(0)
-        best_tags = [best_last_tag[0]]
-
-        #We trace back where the best last tag comes from, append that to our best tag
-        #sequence, and trace it back again, and so on
-        for path in reversed(viterbi_path):
-            best_last_tag = path[best_tags[-1]]
-            best_tags.append(best_last_tag)
-
-        #Reverse the order because we start from the last timestep
-        best_tags.reverse()
-        return best_tags
+        #Decodes the whole batch on the device.
+        if cfg.crf_top_k is not None:
+            tag_ids, top_scores = self.prune(scores)
+            preds = pruned_viterbi(
+                        top_scores.data,
+                        tag_ids.data,
+                        w_mask.data,
+                        self.start_transitions.data,
+                        self.end_transitions.data,
+                        self.transitions.data
+                        )
+        else:
+            preds = viterbi(
+                        scores.data,
+                        w_mask.data,
+                        self.start_transitions.data,
+                        self.end_transitions.data,
+                        self.transitions.data
+                        )
+
+        #preds is of size (batch size, max length)
+        return preds.cpu().numpy()
 
     @staticmethod
     def log_sum_exp(tensor, dim):
@@ -3,6 +3,8 @@ import torch
 from torch.autograd import Variable
 import torch.nn as nn
 from torch.nn import init
+from torch.nn.utils.rnn import pack_padded_sequence
+from torch.nn.utils.rnn import pad_packed_sequence
 
 hasCuda = torch.cuda.is_available()
 
@@ -52,12 +54,20 @@ class Encoder(nn.Module):
     def forward(self, F):
         cfg = self.cfg
 
-        #Create a variable for initial hidden vector of RNNs.
-        zeros = torch.zeros(2, cfg.d_batch_size, cfg.w_rnn_units)
-        h0 = Variable(zeros.cuda()) if hasCuda else Variable(zeros)
+        s_len = Variable(cfg.B['s_len'].cuda()) if hasCuda else Variable(cfg.B['s_len'])
 
-        #Bi-directional RNN
-        outputs, _ = self.w_rnn(F, (h0, h0))
+        #Sentences are sorted by length, and packed without their pad words,
+        #so the backward RNN starts at the last word of each sentence.
+        sorted_len, order = torch.sort(s_len, 0, descending=True)
+        _, unorder = torch.sort(order, 0)
+        packed = pack_padded_sequence(F.index_select(0, order), sorted_len.data.tolist(), batch_first=True)
+
+        #Bi-directional RNN, starting from zero hidden vectors.
+        packed_outputs, _ = self.w_rnn(packed)
+
+        #Outputs of the pad words are zeros.
+        outputs, _ = pad_packed_sequence(packed_outputs, batch_first=True)
+        outputs = outputs.index_select(0, unorder)
 
         outputs_dr = self.drop(outputs)
 
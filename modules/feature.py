@@ -1,12 +1,74 @@
 from itertools import *
+from collections import OrderedDict
 import torch
 import numpy as np
 from torch.autograd import Variable
 import torch.nn as nn
 from torch.nn import init
+from torch.nn.utils.rnn import pack_padded_sequence
 
 hasCuda = torch.cuda.is_available()
 
+class CharCache(object):
+    """
+    LRU cache of the prefix/suffix vectors of words at inference, keyed by their char ids.
+    The vectors are kept in the rows (slots) of one table with at most size rows.
+    """
+    def __init__(self, size):
+        self.size = size
+        self.slots = OrderedDict()
+        self.table = None
+        self.hits = 0
+        self.misses = 0
+        return
+
+    def clear(self):
+        self.slots = OrderedDict()
+        self.table = None
+        return
+
+    def lookup(self, keys):
+        """Returns the rows of the keys which are cached with their slots, and the missing rows."""
+        hit_rows = []
+        hit_slots = []
+        miss_rows = []
+        for row, key in enumerate(keys):
+            slot = self.slots.pop(key, None)
+            if slot is None:
+                miss_rows.append(row)
+            else:
+                #Mark as the most recently used.
+                self.slots[key] = slot
+                hit_rows.append(row)
+                hit_slots.append(slot)
+
+        self.hits += len(hit_rows)
+        self.misses += len(miss_rows)
+        return hit_rows, hit_slots, miss_rows
+
+    def insert(self, keys):
+        """Assigns slots to the new keys, evicting the least recently used keys if the table is full."""
+        slots = []
+        for key in keys:
+            if key in self.slots:
+                slot = self.slots[key]
+            elif len(self.slots) < self.size:
+                slot = len(self.slots)
+            else:
+                _, slot = self.slots.popitem(last=False)
+
+            self.slots[key] = slot
+            slots.append(slot)
+
+        return slots
+
+    def hit_rate(self):
+        lookups = self.hits + self.misses
+        if lookups==0:
+            return 0.0
+
+        return float(self.hits) / lookups
+
 class Feature(nn.Module):
     """
     Implements a character-level bi-direcitonl RNN
@@ -18,23 +80,148 @@ class Feature(nn.Module):
         super(Feature, self).__init__()
 
         self.cfg = cfg
-        self.fw_ch_rnn = nn.LSTMCell(
-                            input_size=cfg.ch_em_size,
-                            hidden_size=cfg.ch_rnn_units,
-                            bias=True
-                            )
 
-        self.bw_ch_rnn = nn.LSTMCell(
+        #The forward direction builds suffixes, and the backward one builds prefixes.
+        self.ch_rnn = nn.LSTM(
                             input_size=cfg.ch_em_size,
                             hidden_size=cfg.ch_rnn_units,
-                            bias=True
+                            num_layers=1,
+                            bias=True,
+                            batch_first=True,
+                            dropout=0.0,
+                            bidirectional=True
                             )
 
         self.drop = nn.Dropout(cfg.dropout)
 
+        #Prefix/suffix vectors of the words seen at inference.
+        self.ch_cache = CharCache(cfg.ch_cache_size)
+
+        #Optional precomputed feature table for inference, see use_table.
+        self.table = None
+        self.table_rows = None
+
         self.param_init()
         self.embeddings()
 
+    def load_state_dict(self, state_dict, strict=True):
+        """Also loads the checkpoints of the former fw_ch_rnn/bw_ch_rnn LSTM cells into ch_rnn."""
+        state_dict = state_dict.copy()
+        for cell, direction in [('fw_ch_rnn', ''), ('bw_ch_rnn', '_reverse')]:
+            for name in ['weight_ih', 'weight_hh', 'bias_ih', 'bias_hh']:
+                key = cell + '.' + name
+                if key in state_dict:
+                    state_dict['ch_rnn.' + name + '_l0' + direction] = state_dict.pop(key)
+
+        #Cached vectors and feature tables belong to the previous weights.
+        self.ch_cache.clear()
+        self.table = None
+        return super(Feature, self).load_state_dict(state_dict, strict)
+
+    def train(self, mode=True):
+        #Weights change in training, so the cached vectors become stale.
+        if mode:
+            self.ch_cache.clear()
+            self.table = None
+        return super(Feature, self).train(mode)
+
+    def use_table(self, table, ids):
+        """
+        Uses a feature table at inference: row i of table has the
+        prefix, suffix and word vectors of the word id ids[i] (see build_table).
+        Other words go through the char RNN.
+        """
+        rows = np.full(self.cfg.w_size, -1, dtype=np.int64)
+        rows[ids] = np.arange(len(ids))
+        self.table = table
+        self.table_rows = rows
+        return
+
+    def build_table(self, ids, table, chunk=4096):
+        """
+        Fills table with the prefix, suffix and word vectors of the word ids,
+        using the dictionary chars of the words. The module should be in eval mode.
+        """
+        cfg = self.cfg
+        w_ch = cfg.data['w_ch']
+        w_ch_off = cfg.data['w_ch_off']
+
+        #zero the pad id vectors
+        self.ch_em.weight.data[cfg.ch_pad_id].fill_(0.0)
+        self.w_em.weight.data[cfg.w_pad_id].fill_(0.0)
+
+        for start in range(0, len(ids), chunk):
+            chunk_ids = ids[start:start + chunk]
+            starts = w_ch_off[chunk_ids].reshape(-1, 1)
+            w_len_np = w_ch_off[chunk_ids + 1] - w_ch_off[chunk_ids]
+            steps = np.arange(w_len_np.max()).reshape(1, -1)
+            valid = steps < w_len_np.reshape(-1, 1)
+            ch_np = np.full(valid.shape, cfg.ch_pad_id, dtype=np.int64)
+            ch_np[valid] = w_ch[(starts + steps)[valid]]
+
+            ch = torch.from_numpy(ch_np)
+            w_len = torch.from_numpy(w_len_np.astype(np.int64))
+            w = torch.from_numpy(chunk_ids.astype(np.int64))
+            ch = Variable(ch.cuda()) if hasCuda else Variable(ch)
+            w_len = Variable(w_len.cuda()) if hasCuda else Variable(w_len)
+            w = Variable(w.cuda()) if hasCuda else Variable(w)
+
+            prefix_ems, suffix_ems = self.char_features(ch, w_len)
+            Words = self.w_em(w)
+            rows = torch.cat((prefix_ems, suffix_ems, Words), 1)
+            table[start:start + len(chunk_ids)] = rows.data.cpu().numpy()
+
+        return
+
+    def table_features(self, ch, w_len, w, w_chs):
+        """
+        Builds the prefix, suffix and word vectors of the batch at inference:
+        words in the table are gathered from it,
+        the other ones go through the char RNN (and the char cache).
+        """
+        cfg = self.cfg
+        size = 2 * cfg.ch_rnn_units + cfg.w_em_size
+
+        w_np = cfg.B['w'].numpy().reshape(-1)
+        valid = cfg.B['w_mask'].numpy().reshape(-1) > 0
+        rows = self.table_rows[w_np]
+        in_table = np.nonzero(valid & (rows >= 0))[0]
+        not_in_table = np.nonzero(valid & (rows < 0))[0]
+
+        #Pad words have zero features.
+        features = torch.zeros(len(w_np), size)
+        features = features.cuda() if hasCuda else features
+
+        if len(in_table)!=0:
+            positions = torch.from_numpy(in_table)
+            positions = positions.cuda() if hasCuda else positions
+            gathered = torch.from_numpy(np.asarray(self.table[rows[in_table]], dtype=np.float32))
+            gathered = gathered.cuda() if hasCuda else gathered
+            features.index_copy_(0, positions, gathered)
+
+        if len(not_in_table)!=0:
+            #Run the char RNN once for each char row used by these words.
+            ch_rows, inverse = np.unique(cfg.B['w_chs'].numpy().reshape(-1)[not_in_table], return_inverse=True)
+            positions = torch.from_numpy(not_in_table)
+            ch_rows = torch.from_numpy(ch_rows)
+            inverse = torch.from_numpy(inverse.astype(np.int64))
+            positions = Variable(positions.cuda()) if hasCuda else Variable(positions)
+            ch_rows = Variable(ch_rows.cuda()) if hasCuda else Variable(ch_rows)
+            inverse = Variable(inverse.cuda()) if hasCuda else Variable(inverse)
+
+            ch_sub = ch.index_select(0, ch_rows)
+            w_len_sub = w_len.index_select(0, ch_rows)
+            if cfg.ch_cache_size > 0:
+                prefix_ems, suffix_ems = self.cached_char_features(ch_sub, w_len_sub)
+            else:
+                prefix_ems, suffix_ems = self.char_features(ch_sub, w_len_sub)
+
+            Words = self.w_em(w.view(-1).index_select(0, positions))
+            vectors = torch.cat((prefix_ems.index_select(0, inverse), suffix_ems.index_select(0, inverse), Words), 1)
+            features.index_copy_(0, positions.data, vectors.data)
+
+        return Variable(features.view(cfg.d_batch_size, cfg.max_s_len, size))
+
     def param_init(self):
         for name, param in self.named_parameters():
             if 'bias' in name:
@@ -72,6 +259,68 @@ class Feature(nn.Module):
         self.ch_em.weight.requires_grad = True
         return
 
+    def char_features(self, ch, w_len):
+        """Runs the char RNN to build the prefix and suffix vectors of the words in ch."""
+        #Words are sorted by length, and packed without their pad chars.
+        sorted_len, order = torch.sort(w_len, 0, descending=True)
+        _, unorder = torch.sort(order, 0)
+        ch_ems = self.ch_em(ch).index_select(0, order)
+        packed = pack_padded_sequence(ch_ems, sorted_len.data.tolist(), batch_first=True)
+
+        #Both directions run in one call.
+        #Last hidden vectors of the forward RNN are suffixes,
+        #and the ones of the backward RNN (at the first char) are prefixes.
+        _, (h_n, _) = self.ch_rnn(packed)
+        suffix_ems = h_n[0].index_select(0, unorder)
+        prefix_ems = h_n[1].index_select(0, unorder)
+        return prefix_ems, suffix_ems
+
+    def cached_char_features(self, ch, w_len):
+        """
+        Same as char_features, but only runs the char RNN for the words missing from the cache.
+        This is only valid at inference, where the vectors of a word only depend on its chars.
+        """
+        cfg = self.cfg
+        cache = self.ch_cache
+        units = cfg.ch_rnn_units
+
+        #Keys are the raw bytes of the char ids of the words.
+        ch_np = ch.data.cpu().numpy()
+        w_len_np = w_len.data.cpu().numpy()
+        keys = [ch_np[r, :w_len_np[r]].tostring() for r in range(len(w_len_np))]
+
+        #The batch should fit in the cache.
+        if len(keys) > cache.size:
+            return self.char_features(ch, w_len)
+
+        if cache.table is None:
+            table = torch.zeros(cache.size, 2 * units)
+            cache.table = table.cuda() if hasCuda else table
+
+        hit_rows, hit_slots, miss_rows = cache.lookup(keys)
+        vectors = torch.zeros(len(keys), 2 * units)
+        vectors = vectors.cuda() if hasCuda else vectors
+
+        if len(hit_rows)!=0:
+            rows = torch.LongTensor(hit_rows)
+            slots = torch.LongTensor(hit_slots)
+            rows = rows.cuda() if hasCuda else rows
+            slots = slots.cuda() if hasCuda else slots
+            vectors.index_copy_(0, rows, cache.table.index_select(0, slots))
+
+        if len(miss_rows)!=0:
+            rows = torch.LongTensor(miss_rows)
+            slots = torch.LongTensor(cache.insert([keys[r] for r in miss_rows]))
+            rows = rows.cuda() if hasCuda else rows
+            slots = slots.cuda() if hasCuda else slots
+            prefix_ems, suffix_ems = self.char_features(ch.index_select(0, Variable(rows)), w_len.index_select(0, Variable(rows)))
+            new_vectors = torch.cat((prefix_ems, suffix_ems), 1).data
+            vectors.index_copy_(0, rows, new_vectors)
+            cache.table.index_copy_(0, slots, new_vectors)
+
+        V = Variable(vectors)
+        return V[:, 0:units], V[:, units:]
+
     def forward(self):
         cfg = self.cfg
 
@@ -81,49 +330,28 @@ class Feature(nn.Module):
 
         #Tensor to Input Variables
         ch = Variable(cfg.B['ch'].cuda()) if hasCuda else Variable(cfg.B['ch'])
-        rev_ch = Variable(cfg.B['rev_ch'].cuda()) if hasCuda else Variable(cfg.B['rev_ch'])
         w_len = Variable(cfg.B['w_len'].cuda()) if hasCuda else Variable(cfg.B['w_len'])
         w = Variable(cfg.B['w'].cuda()) if hasCuda else Variable(cfg.B['w'])
         w_cap = Variable(cfg.B['w_cap'].cuda()) if hasCuda else Variable(cfg.B['w_cap'])
         w_chs = Variable(cfg.B['w_chs'].cuda()) if hasCuda else Variable(cfg.B['w_chs'])
         w_mask = Variable(cfg.B['w_mask'].cuda()) if hasCuda else Variable(cfg.B['w_mask'])
 
-        #Create a variable for initial hidden vector of RNNs.
-        zeros = torch.zeros(ch.size()[0], cfg.ch_rnn_units)
-        h0 = Variable(zeros.cuda()) if hasCuda else Variable(zeros)
-
-        #Forward RNN to build suffix
-        ch_ems = self.ch_em(ch)
-        fw_outputs = []
-        for i in range(cfg.max_w_len):
-            if i==0:
-                fwh = h0
-                fwc = h0
-            fwh, fwc = self.fw_ch_rnn(ch_ems[:,i,:], (fwh, fwc))
-            fw_outputs.append(fwh)
-
-        fw_ch_h = torch.stack(fw_outputs, dim=1)
-
-        #l_index for last valid time step.
-        l_index = (w_len - 1).view(-1, 1, 1).expand(-1, 1, cfg.ch_rnn_units)
-        suffix_ems = torch.gather(fw_ch_h, 1, l_index).view(-1, cfg.ch_rnn_units)
-        S = torch.index_select(suffix_ems, 0, w_chs.view(-1,))
-        Suffixes = S.view(cfg.d_batch_size, cfg.max_s_len, cfg.ch_rnn_units)
+        Caps = self.cap_em(w_cap)
 
+        #At inference, features of the words in the table are a single gather.
+        if not self.training and self.table is not None:
+            features = self.table_features(ch, w_len, w, w_chs)
+            features_dr = self.drop(features)
+            return torch.cat((features_dr, Caps), 2)
 
-        #Backward RNN to build prefix
-        rev_ch_ems = self.ch_em(rev_ch)
-        bw_outputs = []
-        for i in range(cfg.max_w_len):
-            if i==0:
-                bwh = h0
-                bwc = h0
-            bwh, bwc = self.bw_ch_rnn(rev_ch_ems[:,i,:], (bwh, bwc))
-            bw_outputs.append(bwh)
+        if not self.training and cfg.ch_cache_size > 0:
+            prefix_ems, suffix_ems = self.cached_char_features(ch, w_len)
+        else:
+            prefix_ems, suffix_ems = self.char_features(ch, w_len)
 
+        S = torch.index_select(suffix_ems, 0, w_chs.view(-1,))
+        Suffixes = S.view(cfg.d_batch_size, cfg.max_s_len, cfg.ch_rnn_units)
 
-        bw_ch_h = torch.stack(bw_outputs, dim=1)
-        prefix_ems = torch.gather(bw_ch_h, 1, l_index).view(-1, cfg.ch_rnn_units)
         P = torch.index_select(prefix_ems, 0, w_chs.view(-1,))
         Prefixes = P.view(cfg.d_batch_size, cfg.max_s_len, cfg.ch_rnn_units)
 
@@ -133,7 +361,6 @@ class Feature(nn.Module):
         Suffixes_masked = Suffixes * mask_expanded
         Prefixes_masked = Prefixes * mask_expanded
         Words = self.w_em(w)
-        Caps = self.cap_em(w_cap)
 
         features = torch.cat((Prefixes_masked, Suffixes_masked, Words), 2)
         features_dr = self.drop(features)
@@ -0,0 +1,171 @@
+from itertools import *
+import torch
+import torch.nn as nn
+from torch.nn.utils.rnn import pack_padded_sequence
+from torch.nn.utils.rnn import pad_packed_sequence
+from modules.crf import viterbi
+from modules.crf import pruned_viterbi
+
+def greedy_decode(H, tag_em, w_ih, w_hh, b_ih, b_hh, affine_w, affine_b):
+    # type: (Tensor, Tensor, Tensor, Tensor, Tensor, Tensor, Tensor, Tensor) -> Tensor
+    """
+    Greedy decoding with the decoder RNN (an LSTM cell given by its weights),
+    feeding the embedding of the predicted tag to the next step.
+    Returns the predicted tags of size (batch size, max length).
+    """
+    batch_size = H.size(0)
+    max_s_len = H.size(1)
+    units = w_hh.size(1)
+
+    h = torch.zeros([batch_size, units], dtype=H.dtype, device=H.device)
+    c = torch.zeros([batch_size, units], dtype=H.dtype, device=H.device)
+    prev_output = torch.zeros([batch_size, tag_em.size(1)], dtype=H.dtype, device=H.device)
+    preds = torch.zeros([batch_size, max_s_len], dtype=torch.long, device=H.device)
+    for i in range(max_s_len):
+        H_i = H[:, i]
+        input = torch.cat([prev_output, H_i], 1)
+        gates = torch.mm(input, w_ih.t()) + b_ih + torch.mm(h, w_hh.t()) + b_hh
+        in_gate, forget_gate, cell_gate, out_gate = gates.chunk(4, 1)
+        c = torch.sigmoid(forget_gate) * c + torch.sigmoid(in_gate) * torch.tanh(cell_gate)
+        h = torch.sigmoid(out_gate) * torch.tanh(c)
+
+        score = torch.mm(torch.cat([h, H_i], 1), affine_w.t()) + affine_b
+        _, gen_idx = score.max(1)
+        preds[:, i] = gen_idx
+        prev_output = tag_em.index_select(0, gen_idx)
+
+    return preds
+
+def zero_state(input, units):
+    #Sized by the input tensor, so the traced graph does not fix the batch size.
+    return torch.zeros(2, input.size(0), units, dtype=input.dtype, device=input.device)
+
+class TaggingGraph(nn.Module):
+    """
+    The inference graph of a trained model: Feature + Encoder + predictor,
+    with the batch tensors as explicit inputs instead of cfg.B,
+    so it can be exported with TorchScript (see script).
+    Decoder RNNs use greedy search.
+    """
+    def __init__(self, cfg, feature, encoder, predictor):
+        super(TaggingGraph, self).__init__()
+
+        self.model_type = cfg.model_type
+        self.crf_top_k = cfg.crf_top_k
+        self.feature = feature
+        self.encoder = encoder
+        self.predictor = predictor
+
+        #The loops are compiled, so they run for the length of each batch.
+        self.viterbi = torch.jit.script(viterbi)
+        self.pruned_viterbi = torch.jit.script(pruned_viterbi)
+        self.greedy_decode = torch.jit.script(greedy_decode)
+
+        #zero the pad id vectors once, forward does not change the weights.
+        feature.ch_em.weight.data[cfg.ch_pad_id].fill_(0.0)
+        feature.w_em.weight.data[cfg.w_pad_id].fill_(0.0)
+        if self.model_type not in ['INDP', 'CRF']:
+            predictor.tag_em.weight.data[cfg.tag_pad_id].fill_(0.0)
+
+        return
+
+    def features(self, ch, w_len, w, w_cap, w_chs, w_mask):
+        feature = self.feature
+        batch_size = w.size(0)
+        max_s_len = w.size(1)
+
+        #The sorting is done here, so the trace does not depend on the batch size.
+        sorted_len, order = torch.sort(w_len, 0, descending=True)
+        _, unorder = torch.sort(order, 0)
+        ch_ems = feature.ch_em(ch).index_select(0, order)
+        packed = pack_padded_sequence(ch_ems, sorted_len, batch_first=True)
+        h0 = zero_state(ch_ems, feature.ch_rnn.hidden_size)
+        _, (h_n, _) = feature.ch_rnn(packed, (h0, h0))
+
+        #Rows of ch for the words of the sentences.
+        rows = unorder.index_select(0, w_chs.view(-1))
+        P = h_n[1].index_select(0, rows).view(batch_size, max_s_len, -1)
+        S = h_n[0].index_select(0, rows).view(batch_size, max_s_len, -1)
+        mask = w_mask.unsqueeze(2)
+
+        Words = feature.w_em(w)
+        Caps = feature.cap_em(w_cap)
+        return torch.cat((P * mask, S * mask, Words, Caps), 2)
+
+    def hidden(self, F, s_len):
+        encoder = self.encoder
+        sorted_len, order = torch.sort(s_len, 0, descending=True)
+        _, unorder = torch.sort(order, 0)
+        packed = pack_padded_sequence(F.index_select(0, order), sorted_len, batch_first=True)
+        h0 = zero_state(F, encoder.w_rnn.hidden_size)
+        packed_outputs, _ = encoder.w_rnn(packed, (h0, h0))
+        outputs, _ = pad_packed_sequence(packed_outputs, batch_first=True)
+        return torch.tanh(encoder.dense(outputs.index_select(0, unorder)))
+
+    def forward(self, ch, w_len, w, w_cap, w_chs, w_mask, s_len):
+        """
+        Inputs are the ones of a batch built by load.build_batch:
+            ch: (words, max_w_len) char ids of the distinct words, w_len: their lengths.
+            w, w_cap, w_chs: (batch size, max_s_len) word ids, cap ids and row of each word in ch.
+            w_mask: (batch size, max_s_len) 1.0 for words and 0.0 for pads.
+            s_len: (batch size,) number of words of each sentence, with max(s_len) == max_s_len.
+        Returns the tag ids of size (batch size, max_s_len).
+        """
+        F = self.features(ch, w_len, w, w_cap, w_chs, w_mask)
+        H = self.hidden(F, s_len)
+        predictor = self.predictor
+        if self.model_type=='INDP':
+            _, preds = predictor.affine(H).max(2)
+
+        elif self.model_type=='CRF' and self.crf_top_k is not None:
+            scores = predictor.affine(H)
+            top_scores, tag_ids = scores.topk(min(self.crf_top_k, scores.size(2)), 2)
+            preds = self.pruned_viterbi(
+                                top_scores,
+                                tag_ids,
+                                w_mask,
+                                predictor.start_transitions,
+                                predictor.end_transitions,
+                                predictor.transitions
+                                )
+
+        elif self.model_type=='CRF':
+            preds = self.viterbi(
+                                predictor.affine(H),
+                                w_mask,
+                                predictor.start_transitions,
+                                predictor.end_transitions,
+                                predictor.transitions
+                                )
+
+        else:
+            preds = self.greedy_decode(
+                                H,
+                                predictor.tag_em.weight,
+                                predictor.dec_rnn.weight_ih,
+                                predictor.dec_rnn.weight_hh,
+                                predictor.dec_rnn.bias_ih,
+                                predictor.dec_rnn.bias_hh,
+                                predictor.affine.weight,
+                                predictor.affine.bias
+                                )
+
+        return preds
+
+def example_inputs(cfg):
+    """A small batch of two sentences with different lengths, used to trace the graph."""
+    ch = torch.LongTensor([[0, 1, 2], [1, 2, cfg.ch_pad_id], [2, cfg.ch_pad_id, cfg.ch_pad_id]])
+    w_len = torch.LongTensor([3, 2, 1])
+    w = torch.LongTensor([[0, 1, 2], [1, 0, cfg.w_pad_id]])
+    w_cap = torch.LongTensor([[2, 0, 0], [0, 0, cfg.cap_pad_id]])
+    w_chs = torch.LongTensor([[0, 1, 2], [1, 0, 0]])
+    w_mask = torch.FloatTensor([[1.0, 1.0, 1.0], [1.0, 1.0, 0.0]])
+    s_len = torch.LongTensor([3, 2])
+    return (ch, w_len, w, w_cap, w_chs, w_mask, s_len)
+
+def script(cfg, feature, encoder, predictor):
+    """Traces the inference graph of the trained modules into a TorchScript module (on CPU)."""
+    graph = TaggingGraph(cfg, feature, encoder, predictor)
+    graph.cpu()
+    graph.eval()
+    return torch.jit.trace(graph, example_inputs(cfg), check_trace=False)
@@ -4,9 +4,25 @@ import numpy as np
 import torch.nn as nn
 from torch.nn import init
 from torch.autograd import Variable
+from modules.util import length_order
+from modules.util import pad_rows
 
 hasCuda = torch.cuda.is_available()
 
+def step(projection, i, n=None, beamsize=1):
+    """
+        The projection of step i (see MLDecoder.projections) for the first n sentences
+        (all if n is None), repeated for each beam. None stays None.
+    """
+    if projection is None:
+        return None
+
+    projection_i = projection[i][:n]
+    if beamsize > 1:
+        projection_i = projection_i.unsqueeze(1).expand(-1, beamsize, -1).contiguous().view(-1, projection_i.size(1))
+
+    return projection_i
+
 class MLDecoder(nn.Module):
     """
     This module is for prediction of the tags using a decoder RNN.
@@ -28,6 +44,18 @@ class MLDecoder(nn.Module):
                             bias=True
                             )
 
+        #The same decoder RNN over whole sequences, for teacher forcing.
+        #It shares the weights of dec_rnn, so greedy and beam search decode with the trained weights.
+        self.seq_rnn = nn.LSTM(
+                            input_size=in_size,
+                            hidden_size=cfg.dec_rnn_units,
+                            num_layers=1,
+                            bias=True,
+                            batch_first=True
+                            )
+        for name in ['weight_ih', 'weight_hh', 'bias_ih', 'bias_hh']:
+            setattr(self.seq_rnn, name + '_l0', getattr(self.dec_rnn, name))
+
         #This is a linear affine layer.
         self.affine = nn.Linear(
                             cfg.w_rnn_units + cfg.dec_rnn_units,
@@ -37,6 +65,10 @@ class MLDecoder(nn.Module):
 
         self.drop = nn.Dropout(cfg.dropout)
 
+        #Verification passes of speculative decoding, and the steps of greedy search on the same batches.
+        self.passes = 0
+        self.steps = 0
+
         self.param_init()
         self.embeddings()
 
@@ -50,6 +82,23 @@ class MLDecoder(nn.Module):
                 init.xavier_uniform(param)
         return
 
+    def load_state_dict(self, state_dict, strict=True):
+        """Also loads the checkpoints saved before seq_rnn, whose weights are the ones of dec_rnn."""
+        #The copy keeps the versions of the layers, quantized layers load by them.
+        metadata = getattr(state_dict, '_metadata', None)
+        state_dict = state_dict.copy()
+        if metadata is not None:
+            state_dict._metadata = metadata
+
+        #Quantized layers have other keys.
+        keys = self.state_dict().keys()
+        for name in ['weight_ih', 'weight_hh', 'bias_ih', 'bias_hh']:
+            key = 'seq_rnn.' + name + '_l0'
+            if key in keys and key not in state_dict and 'dec_rnn.' + name in state_dict:
+                state_dict[key] = state_dict['dec_rnn.' + name]
+
+        return super(MLDecoder, self).load_state_dict(state_dict, strict)
+
     def embeddings(self):
         """Add embedding layer that maps from tag ids to tag feature vectors."""
         cfg = self.cfg
@@ -58,6 +107,56 @@ class MLDecoder(nn.Module):
         self.tag_em.weight.requires_grad = True
         return
 
+    def projections(self, H):
+        """
+            The decoder RNN input is cat(previous tag, Hi), and the affine input is cat(output, Hi),
+            so the Hi parts of both projections are computed for all the steps at once:
+            'gates_H' (batch size, max length, 4 * dec_rnn_units) with both RNN biases,
+            and 'scores_H' (batch size, max length, tag size) with the affine bias.
+            They are unbound into the steps, and the weights of the other parts
+            are sliced once, so the backward pass does not copy them at each step.
+            A projection is None if its layer has no float weights (e.g. quantized),
+            then the steps run the layer on the concatenated input.
+        """
+        cfg = self.cfg
+        proj = {'gates_H': None, 'scores_H': None}
+        if isinstance(self.dec_rnn, nn.LSTMCell):
+            W_H = self.dec_rnn.weight_ih[:, cfg.tag_em_size:]
+            gates_H = torch.matmul(H, W_H.t()) + self.dec_rnn.bias_ih + self.dec_rnn.bias_hh
+            proj['gates_H'] = torch.unbind(gates_H, 1)
+            proj['W_tag'] = self.dec_rnn.weight_ih[:, :cfg.tag_em_size].t()
+            proj['W_hh'] = self.dec_rnn.weight_hh.t()
+
+        if isinstance(self.affine, nn.Linear):
+            W_H = self.affine.weight[:, cfg.dec_rnn_units:]
+            scores_H = torch.matmul(H, W_H.t()) + self.affine.bias
+            proj['scores_H'] = torch.unbind(scores_H, 1)
+            proj['W_output'] = self.affine.weight[:, :cfg.dec_rnn_units].t()
+
+        return proj
+
+    def cell(self, prev_output, Hi, state, proj, i, n=None, beamsize=1):
+        """One step i of the decoder RNN for the first n sentences (see projections and step)."""
+        gates_Hi = step(proj['gates_H'], i, n, beamsize)
+        if gates_Hi is None:
+            input = torch.cat((prev_output, Hi), dim=1)
+            return self.dec_rnn(input, state)
+
+        h, c = state
+        gates = torch.addmm(gates_Hi, prev_output, proj['W_tag']) + torch.mm(h, proj['W_hh'])
+        in_gate, forget_gate, cell_gate, out_gate = gates.chunk(4, 1)
+        c = nn.functional.sigmoid(forget_gate) * c + nn.functional.sigmoid(in_gate) * nn.functional.tanh(cell_gate)
+        h = nn.functional.sigmoid(out_gate) * nn.functional.tanh(c)
+        return h, c
+
+    def score(self, output, Hi, proj, i, n=None, beamsize=1):
+        """Tag scores of step i for the first n sentences (see projections and step)."""
+        scores_Hi = step(proj['scores_H'], i, n, beamsize)
+        if scores_Hi is None:
+            return self.affine(torch.cat((output, Hi), dim=1))
+
+        return torch.addmm(scores_Hi, output, proj['W_output'])
+
     def forward(self, H):
         cfg = self.cfg
         """
@@ -82,44 +181,27 @@ class MLDecoder(nn.Module):
 
         tag = Variable(cfg.B['tag'].cuda()) if hasCuda else Variable(cfg.B['tag'])
 
-
         tag_ems = self.tag_em(tag)
 
-        #Create a variable for initial hidden vector of RNN.
-        zeros = torch.zeros(cfg.d_batch_size, cfg.dec_rnn_units)
-        h0 = Variable(zeros.cuda()) if hasCuda else Variable(zeros)
-
         #Create a variable for the initial previous tag.
-        zeros = torch.zeros(cfg.d_batch_size, cfg.tag_em_size)
+        zeros = torch.zeros(cfg.d_batch_size, 1, cfg.tag_em_size)
         Go_symbol = Variable(zeros.cuda()) if hasCuda else Variable(zeros)
 
-        Scores = []
-        for i in range(cfg.max_s_len):
-            Hi = H[:,i,:]
-            if i==0:
-                prev_output = Go_symbol
-                h = h0
-                c = h0
-
-            input = torch.cat((prev_output, Hi), dim=1)
+        #Teachor Force the previous gold tags:
+        #the inputs of all the steps are known, so seq_rnn runs them in one call.
+        prev_outputs = torch.cat((Go_symbol, tag_ems[:,:-1,:]), dim=1)
+        inputs = torch.cat((prev_outputs, H), dim=2)
 
-            output, c = self.dec_rnn(input, (h, c))
+        #Pad steps run too, their scores are masked in the loss.
+        #Starting from zero hidden vectors.
+        outputs, _ = self.seq_rnn(inputs)
 
-            output_dr = self.drop(output)
-            output_dr_H = torch.cat((output_dr, Hi), dim=1)
-
-            score = self.affine(output_dr_H)
-            Scores.append(score)
-
-            #For the next step
-            h = output
-
-            #Teachor Force the previous gold tag.
-            prev_output = tag_ems[:,i,:]
+        outputs_dr = self.drop(outputs)
 
+        Scores = self.affine(torch.cat((outputs_dr, H), dim=2))
 
         #Return log_probs
-        return nn.functional.log_softmax(torch.stack(Scores, dim=1), dim=2)
+        return nn.functional.log_softmax(Scores, dim=2)
 
     def SS_forward(self, H):
         cfg = self.cfg
@@ -150,6 +232,9 @@ class MLDecoder(nn.Module):
         zeros = torch.zeros(cfg.d_batch_size, cfg.tag_em_size)
         Go_symbol = Variable(zeros.cuda()) if hasCuda else Variable(zeros)
 
+        #Projections of H for all the steps.
+        proj = self.projections(H)
+
         Scores = []
         for i in range(cfg.max_s_len):
             Hi = H[:,i,:]
@@ -158,13 +243,11 @@ class MLDecoder(nn.Module):
                 h = h0
                 c = h0
 
-            input = torch.cat((prev_output, Hi), dim=1)
-
-            output, c = self.dec_rnn(input, (h, c))
+            output, c = self.cell(prev_output, Hi, (h, c), proj, i)
 
             output_dr = self.drop(output)
-            output_dr_H = torch.cat((output_dr, Hi), dim=1)
-            score = self.affine(output_dr_H)
+
+            score = self.score(output_dr, Hi, proj, i)
             Scores.append(score)
 
             #For the next step
@@ -197,6 +280,11 @@ class MLDecoder(nn.Module):
         #zero the pad vector
         self.tag_em.weight.data[cfg.tag_pad_id].fill_(0.0)
 
+        #Sentences are sorted by length, and each step only runs
+        #the sentences which have not ended (the first active[i] ones).
+        order, unorder, active = length_order(cfg)
+        H = H.index_select(0, order)
+
         #Create a variable for initial hidden vector of RNN.
         zeros = torch.zeros(cfg.d_batch_size, cfg.dec_rnn_units)
         h0 = Variable(zeros.cuda()) if hasCuda else Variable(zeros)
@@ -205,42 +293,143 @@ class MLDecoder(nn.Module):
         zeros = torch.zeros(cfg.d_batch_size, cfg.tag_em_size)
         Go_symbol = Variable(zeros.cuda()) if hasCuda else Variable(zeros)
 
-        Scores = []
+        #Projections of H for all the steps.
+        proj = self.projections(H)
+
+        Preds = []
+        Log_p = []
         for i in range(cfg.max_s_len):
-            H_i = H[:,i,:]
+            n = active[i]
+            H_i = H[:n,i,:]
             if i==0:
                 prev_output = Go_symbol
                 h = h0
                 c = h0
 
-            input = torch.cat((prev_output, H_i), dim=1)
-
-            output, c = self.dec_rnn(input, (h, c))
+            output, c = self.cell(prev_output[:n], H_i, (h[:n], c[:n]), proj, i, n)
 
-            output_H = torch.cat((output, H_i), dim=1)
-            score = self.affine(output_H)
-            Scores.append(score)
+            score = self.score(output, H_i, proj, i, n)
 
             #For the next step
             h = output
 
-            _, gen_idx = nn.functional.softmax(score, dim=1).max(dim=1)
+            log_p, gen_idx = nn.functional.log_softmax(score, dim=1).max(dim=1)
             generated_prev_output = self.tag_em(gen_idx)
             prev_output = generated_prev_output
 
-        log_probs = nn.functional.log_softmax(torch.stack(Scores, dim=1), dim=2)
-        log_p, preds = log_probs.max(dim=2)
+            #Pad tags for the ended sentences.
+            Preds.append(pad_rows(gen_idx, cfg.d_batch_size, cfg.tag_pad_id))
+            Log_p.append(pad_rows(log_p, cfg.d_batch_size, 0.0))
+
+        preds = torch.stack(Preds, dim=1).index_select(0, unorder)
+        log_p = torch.stack(Log_p, dim=1).index_select(0, unorder)
         return preds, log_p
 
-    def beam(self, H):
+    def speculative(self, H):
+        """
+            Greedy search with parallel passes of seq_rnn instead of one step per tag.
+            The draft is decoded with zero previous tag vectors (the pad tag),
+            then each pass teacher forces the draft: the tags up to the first one
+            that changes are the greedy ones, and the rest of the pass is the next draft.
+            Each pass only runs the steps after the shortest verified prefix,
+            and the sentences which are fully verified leave the batch.
+            Returns the same tags as greedy, and its log probs up to float rounding.
+        """
         cfg = self.cfg
-        beamsize = cfg.beamsize
 
+        #A quantized seq_rnn has its own weights, so it would not give the greedy tags of dec_rnn.
+        #Greedy search runs one pass per step.
+        if not isinstance(self.dec_rnn, nn.LSTMCell) or not isinstance(self.seq_rnn, nn.LSTM):
+            self.passes += cfg.max_s_len
+            self.steps += cfg.max_s_len
+            return self.greedy(H)
+
+        #zero the pad vector
+        self.tag_em.weight.data[cfg.tag_pad_id].fill_(0.0)
+
+        s_len = Variable(cfg.B['s_len'].cuda()) if hasCuda else Variable(cfg.B['s_len'])
+
+        #Column i of Tags is the previous tag of step i, the first one is the pad tag as the Go symbol.
+        tags = torch.LongTensor(cfg.d_batch_size, cfg.max_s_len + 1).fill_(cfg.tag_pad_id)
+        Tags = Variable(tags.cuda()) if hasCuda else Variable(tags)
+        log_p = torch.zeros(cfg.d_batch_size, cfg.max_s_len)
+        Log_p = Variable(log_p.cuda()) if hasCuda else Variable(log_p)
+
+        #Number of greedy tags of each sentence.
+        verified = torch.zeros(cfg.d_batch_size).long()
+        Verified = Variable(verified.cuda()) if hasCuda else Variable(verified)
+
+        steps = torch.arange(0, cfg.max_s_len).long()
+        Steps = Variable(steps.cuda()) if hasCuda else Variable(steps)
+
+        rows = torch.arange(0, cfg.d_batch_size).long()
+        Rows = Variable(rows.cuda()) if hasCuda else Variable(rows)
+
+        #Create a variable for initial hidden vector of RNN.
+        zeros = torch.zeros(1, cfg.d_batch_size, cfg.dec_rnn_units)
+        h = Variable(zeros.cuda()) if hasCuda else Variable(zeros)
+        c = Variable(zeros.cuda()) if hasCuda else Variable(zeros)
+
+        start = 0
+        while True:
+            end = int(s_len.index_select(0, Rows).max())
+            H_span = H.index_select(0, Rows)[:,start:end,:]
+            prev_outputs = self.tag_em(Tags.index_select(0, Rows)[:,start:end])
+            outputs, _ = self.seq_rnn(torch.cat((prev_outputs, H_span), dim=2), (h, c))
+            scores = self.affine(torch.cat((outputs, H_span), dim=2))
+            log_p, gen_idx = nn.functional.log_softmax(scores, dim=2).max(dim=2)
+            self.passes += 1
+
+            #The first changed tag after the verified prefix is a greedy tag, the following ones are not.
+            draft = Tags.index_select(0, Rows)[:,start+1:end+1]
+            span = Steps[start:end].view(1, -1)
+            row_len = s_len.index_select(0, Rows).view(-1, 1)
+            unverified = span >= Verified.index_select(0, Rows).view(-1, 1)
+            changed = (gen_idx != draft) & unverified & (span < row_len)
+            first = span.expand_as(changed).masked_fill(changed==0, cfg.max_s_len).min(dim=1)[0]
+            verified = torch.min(first + 1, row_len.view(-1))
+            Verified[Rows] = verified
+
+            #Verified tags are kept, so a near tie in the recomputation cannot change them.
+            Tags[Rows, start+1:end+1] = torch.where(unverified, gen_idx, draft)
+            Log_p[Rows, start:end] = torch.where(unverified, log_p, Log_p.index_select(0, Rows)[:,start:end])
+
+            #Only the sentences with unverified tags run the next pass.
+            running = (verified < row_len.view(-1)).nonzero()
+            if len(running)==0:
+                break
+
+            running = running.view(-1)
+            Rows = Rows.index_select(0, running)
+            next_start = int(verified.index_select(0, running).min())
+
+            #The hidden vectors up to the next start only depend on verified tags.
+            H_span = H.index_select(0, Rows)[:,start:next_start,:]
+            prev_outputs = self.tag_em(Tags.index_select(0, Rows)[:,start:next_start])
+            state = (h.index_select(1, running), c.index_select(1, running))
+            _, (h, c) = self.seq_rnn(torch.cat((prev_outputs, H_span), dim=2), state)
+            start = next_start
+
+        self.steps += cfg.max_s_len
+
+        #Pad tags for the ended sentences.
         w_mask = Variable(cfg.B['w_mask'].cuda()) if hasCuda else Variable(cfg.B['w_mask'])
+        preds = Tags[:,1:].masked_fill(w_mask==0, cfg.tag_pad_id)
+        log_p = Log_p.masked_fill(w_mask==0, 0.0)
+        return preds, log_p
+
+    def beam(self, H):
+        cfg = self.cfg
+        beamsize = cfg.beamsize
 
         #zero the pad vector
         self.tag_em.weight.data[cfg.tag_pad_id].fill_(0.0)
 
+        #Sentences are sorted by length, and each step only runs
+        #the sentences which have not ended (the first active[i] ones).
+        order, unorder, active = length_order(cfg)
+        H = H.index_select(0, order)
+
         #Create a variable for initial hidden vector of RNN.
         zeros = torch.zeros(cfg.d_batch_size, cfg.dec_rnn_units)
         h0 = Variable(zeros.cuda()) if hasCuda else Variable(zeros)
@@ -250,81 +439,69 @@ class MLDecoder(nn.Module):
         zeros = torch.zeros(cfg.d_batch_size, cfg.tag_em_size)
         Go_symbol = Variable(zeros.cuda()) if hasCuda else Variable(zeros)
 
-        very_negative = torch.zeros(cfg.d_batch_size)
-        V_Neg = Variable(very_negative.cuda()) if hasCuda else Variable(very_negative)
-        V_Neg.data.fill_(-10**10)
-
-        pads = torch.zeros(cfg.d_batch_size).long()
-        Pads = Variable(pads.cuda()) if hasCuda else Variable(pads)
-        Pads.data.fill_(cfg.tag_pad_id)
-
-        lprob_candidates = torch.zeros(cfg.d_batch_size, beamsize*beamsize)
-        lprob_c = Variable(lprob_candidates.cuda()) if hasCuda else Variable(lprob_candidates)
+        #Row of the first beam of each sentence, in the (batch size * beam size) rows.
+        offsets = torch.arange(0, cfg.d_batch_size).long().view(-1, 1) * beamsize
+        Offsets = Variable(offsets.cuda()) if hasCuda else Variable(offsets)
 
-        tag_candidates = torch.zeros(cfg.d_batch_size, beamsize*beamsize).long()
-        tag_c = Variable(tag_candidates.cuda()) if hasCuda else Variable(tag_candidates)
+        #Beams are folded into the batch dimension: row s * beamsize + b is the beam b of the sentence s.
+        #Each step keeps the tag of each beam, and the beam of the previous step it extends.
+        #The beams of an ended sentence are final, and sorted by their log prob.
+        #Projections of H for all the steps.
+        proj = self.projections(H)
 
-        h_candidates = torch.zeros(cfg.d_batch_size, beamsize*beamsize, cfg.dec_rnn_units)
-        h_c = Variable(h_candidates.cuda()) if hasCuda else Variable(h_candidates)
-
-        c_candidates = torch.zeros(cfg.d_batch_size, beamsize*beamsize, cfg.dec_rnn_units)
-        c_c = Variable(c_candidates.cuda()) if hasCuda else Variable(c_candidates)
-
-        beam = []
+        Tags = []
+        Parents = []
         for i in range(cfg.max_s_len):
-            Hi = H[:,i,:]
-            hasEnd_i = w_mask[:,i].contiguous().view(-1, 1).expand(-1, beamsize) # 1 not finished, 0 finished.
+            n = active[i]
+            Hi = H[:n,i,:]
             if i==0:
-                input = torch.cat((Go_symbol, Hi), dim=1)
-                output, temp_c = self.dec_rnn(input, (h0, c0))
-                output_H = torch.cat((output, Hi), dim=1)
-                score = self.affine(output_H)
+                output, c = self.cell(Go_symbol, Hi, (h0, c0), proj, i)
+                score = self.score(output, Hi, proj, i)
                 log_prob = nn.functional.log_softmax(score, dim=1)
-                log_prob.data[:, cfg.tag_pad_id] = V_Neg.data #never select pad
-                kprob, kidx = torch.topk(log_prob, beamsize, dim=1, largest=True, sorted=True)
+                log_prob.data[:, cfg.tag_pad_id] = -10**10 #never select pad
+                prev_lprob, prev_tag = torch.topk(log_prob, beamsize, dim=1, largest=True, sorted=True)
 
                 #For the time step > 1
-                h = torch.stack([output] * beamsize, dim=1)
-                c = torch.stack([temp_c] * beamsize, dim=1)
-                prev_tag = kidx
-                prev_lprob = kprob
-                beam = kidx.view(-1, beamsize, 1)
-
+                h = output.unsqueeze(1).expand(-1, beamsize, -1).contiguous().view(-1, cfg.dec_rnn_units)
+                c = c.unsqueeze(1).expand(-1, beamsize, -1).contiguous().view(-1, cfg.dec_rnn_units)
 
             else:
-                beam_candidates = []
-                prev_output = self.tag_em(prev_tag)
-                for b in range(beamsize):
-                    input = torch.cat((prev_output[:,b,:], Hi), dim=1)
-                    output, temp_c = self.dec_rnn(input, (h[:,b,:], c[:,b,:]))
-                    output_H = torch.cat((output, Hi), dim=1)
-                    score = self.affine(output_H)
-
-                    log_prob = nn.functional.log_softmax(score, dim=1)
-                    log_prob.data[:, cfg.tag_pad_id] = V_Neg.data #never select pad
-
-                    kprob, kidx = torch.topk(log_prob, beamsize, dim=1, largest=True, sorted=True)
+                #Hi of each beam is only needed by layers without projections.
+                Hi_beams = None
+                if proj['gates_H'] is None or proj['scores_H'] is None:
+                    Hi_beams = Hi.unsqueeze(1).expand(-1, beamsize, -1).contiguous().view(-1, cfg.w_rnn_units)
 
-                    for bb in range(beamsize):
-                        new_lprob = prev_lprob[:,b] + hasEnd_i[:,b] * kprob[:,bb]
-                        lprob_c.data[:, beamsize*b + bb] = new_lprob.data
-                        tag_c.data[:, beamsize*b + bb] = (hasEnd_i[:,b].long() * kidx[:,bb] + (1.0 - hasEnd_i[:,b].long()) * Pads).data
-                        h_c.data[:, beamsize*b + bb, :] = output.data
-                    	c_c.data[:, beamsize*b + bb, :] = temp_c.data
-                        beam_candidates.append(torch.cat((beam[:,b], tag_c[:, beamsize*b + bb].contiguous().view(-1, 1)), 1))
+                prev_output = self.tag_em(prev_tag[:n].contiguous().view(-1))
 
-                    for bb in range(1, beamsize):
-                        lprob_c.data[:,beamsize*b + bb] = (lprob_c[:, beamsize*b + bb] + (1.0-hasEnd_i[:,b]) * V_Neg).data
-
-                _, maxidx = torch.topk(lprob_c, beamsize, dim=1, largest=True, sorted=True)
-
-                beam = torch.gather(torch.stack(beam_candidates, dim=1), 1, maxidx.view(-1, beamsize, 1).expand(-1, beamsize, i+1))
-                prev_tag = torch.gather(tag_c, 1, maxidx)
-                prev_lprob = torch.gather(lprob_c, 1, maxidx)
-                h = torch.gather(h_c, 1, maxidx.view(-1, beamsize, 1).expand(-1, beamsize, cfg.dec_rnn_units))
-                c = torch.gather(c_c, 1, maxidx.view(-1, beamsize, 1).expand(-1, beamsize, cfg.dec_rnn_units))
-
-
-        preds = beam
+                #One step for all the beams of the running sentences.
+                output, c = self.cell(prev_output, Hi_beams, (h[:n*beamsize], c[:n*beamsize]), proj, i, n, beamsize)
+                score = self.score(output, Hi_beams, proj, i, n, beamsize)
+                log_prob = nn.functional.log_softmax(score, dim=1)
+                log_prob.data[:, cfg.tag_pad_id] = -10**10 #never select pad
+                log_prob = log_prob.view(-1, beamsize, cfg.tag_size)
+
+                #The best extensions over (beam size * tags) candidates.
+                lprob_c = prev_lprob[:n].unsqueeze(2) + log_prob
+                prev_lprob, maxidx = torch.topk(lprob_c.view(-1, beamsize * cfg.tag_size), beamsize, dim=1, largest=True, sorted=True)
+                parent = maxidx / cfg.tag_size
+                prev_tag = maxidx - parent * cfg.tag_size
+
+                rows = (parent + Offsets[:n]).view(-1)
+                h = output.index_select(0, rows)
+                c = c.index_select(0, rows)
+                Parents.append(parent)
+
+            Tags.append(prev_tag)
+
+        #Trace back the tags of the final beams, with pad tags after the end of each sentence.
+        beams = torch.arange(0, beamsize).long().view(1, -1).expand(cfg.d_batch_size, -1)
+        beams = Variable(beams.cuda()) if hasCuda else Variable(beams)
+        preds = []
+        for i in reversed(range(cfg.max_s_len)):
+            n = active[i]
+            preds.append(pad_rows(Tags[i].gather(1, beams[:n]), cfg.d_batch_size, cfg.tag_pad_id))
+            if i > 0: beams = torch.cat((Parents[i-1].gather(1, beams[:n]), beams[n:]), 0)
+
+        preds = torch.stack(preds[::-1], dim=2).index_select(0, unorder)
         #preds is of size (batch size, beam size, max length)
         return preds, None
@@ -4,6 +4,8 @@ import numpy as np
 import torch.nn as nn
 from torch.nn import init
 from torch.autograd import Variable
+from modules.util import length_order
+from modules.util import pad_rows
 
 hasCuda = torch.cuda.is_available()
 
@@ -96,13 +98,16 @@ class RLTrain(nn.Module):
 
     def forward(self, H, mldecoder):
         cfg = self.cfg
-        dec_rnn = mldecoder.dec_rnn
-        affine = mldecoder.affine
         tag_em = mldecoder.tag_em
 
         #zero the pad vector
         tag_em.weight.data[cfg.tag_pad_id].fill_(0.0)
 
+        #Sentences are sorted by length, and each step only runs
+        #the sentences which have not ended (the first active[i] ones).
+        order, unorder, active = length_order(cfg)
+        H = H.index_select(0, order)
+
         #Create a variable for initial hidden vector of RNN.
         zeros = torch.zeros(cfg.d_batch_size, cfg.dec_rnn_units)
         h0 = Variable(zeros.cuda()) if hasCuda else Variable(zeros)
@@ -115,35 +120,39 @@ class RLTrain(nn.Module):
         states = []
         taken_actions = []
         action_log_policies = []
+        #Projections of H for all the steps.
+        proj = mldecoder.projections(H)
+
         for i in range(cfg.max_s_len):
-            H_i = H[:,i,:]
+            n = active[i]
+            H_i = H[:n,i,:]
             if i==0:
                 prev_output = Go_symbol
                 h = h0
                 c = h0
 
-            input = torch.cat((prev_output, H_i), dim=1)
-
-            output, c = dec_rnn(input, (h, c))
+            output, c = mldecoder.cell(prev_output[:n], H_i, (h[:n], c[:n]), proj, i, n)
 
             output_H = torch.cat((output, H_i), dim=1)
 
-            states.append(output_H)
+            #The ended sentences have zero states, pad actions and zero log policies,
+            #which are masked in Actor_Critic.
+            states.append(pad_rows(output_H, cfg.d_batch_size, 0.0))
 
-            score = affine(output_H)
+            score = mldecoder.score(output, H_i, proj, i, n)
 
             #For the next step
             h = output
 
             log_p, gen_idx = nn.functional.log_softmax(score, dim=1).max(dim=1)
             prev_output = tag_em(gen_idx)
-            taken_actions.append(gen_idx)
-            action_log_policies.append(log_p)
+            taken_actions.append(pad_rows(gen_idx, cfg.d_batch_size, cfg.tag_pad_id))
+            action_log_policies.append(pad_rows(log_p, cfg.d_batch_size, 0.0))
 
-        S = torch.stack(states, dim=1)
+        S = torch.stack(states, dim=1).index_select(0, unorder)
         V_es = self.V(S)
-        taken_actions = torch.stack(taken_actions, dim=1)
-        action_log_policies = torch.stack(action_log_policies, dim=1)
+        taken_actions = torch.stack(taken_actions, dim=1).index_select(0, unorder)
+        action_log_policies = torch.stack(action_log_policies, dim=1).index_select(0, unorder)
 
         type = cfg.rltrain_type
 
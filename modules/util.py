@@ -0,0 +1,33 @@
+from itertools import *
+import torch
+import numpy as np
+from torch.autograd import Variable
+
+hasCuda = torch.cuda.is_available()
+
+def length_order(cfg):
+    """
+    Sorts the sentences of the batch by length (longest first).
+    Returns the order, its inverse, and the number of sentences longer than i for each step i,
+    so the sentences still running at step i are the first ones in this order.
+    """
+    s_len = cfg.B['s_len'].numpy()
+    order = np.argsort(-s_len, kind='mergesort')
+    unorder = np.argsort(order, kind='mergesort')
+    active = [int(n) for n in np.sum(s_len.reshape(1, -1) > np.arange(cfg.max_s_len).reshape(-1, 1), axis=1)]
+
+    order = torch.from_numpy(order)
+    unorder = torch.from_numpy(unorder)
+    order = Variable(order.cuda()) if hasCuda else Variable(order)
+    unorder = Variable(unorder.cuda()) if hasCuda else Variable(unorder)
+    return order, unorder, active
+
+def pad_rows(x, rows, value):
+    """Appends rows filled with value to x, so it has the given number of rows."""
+    if x.size(0)==rows:
+        return x
+
+    size = list(x.size())
+    size[0] = rows - x.size(0)
+    pads = Variable(x.data.new(*size).fill_(value))
+    return torch.cat((x, pads), 0)
@@ -1,15 +1,22 @@
 from config import Configuration
 from load import load_embeddings
-from load import load_data
+from load import batch_plans
+from load import make_batch
+from load import prefetch
+from load import compile_data
+from load import file_stamp
+from load import valid_cache
+from load import save_cache_stamp
 from modules.feature import Feature
 from modules.encoder import Encoder
 from modules.mldecoder import MLDecoder
 from modules.indp import INDP
 from modules.rltrain import RLTrain
 from modules.crf import CRF
-from random import shuffle
+from modules.graph import script
 from itertools import ifilter
 import torch
+import torch.nn as nn
 import torch.optim as optim
 import numpy as np
 import random
@@ -18,6 +25,13 @@ import os
 import sys
 import time
 import codecs
+import json
+
+#Dynamic quantization is only available in recent versions of torch.
+try:
+    from torch.quantization import quantize_dynamic
+except ImportError:
+    quantize_dynamic = None
 
 reload(sys)
 sys.setdefaultencoding('utf-8')
@@ -41,30 +55,44 @@ m_opt = None
 r_opt = None
 
 def batch_to_tensors(cfg, in_B):
+    #The batch arrays are wrapped without copying.
+    #This runs in the prefetch workers, so it should not depend on cfg.B or batch sizes in cfg.
     o_B = {}
-    o_B['ch'] = torch.LongTensor(in_B['ch'])
-    o_B['rev_ch'] = torch.LongTensor(in_B['rev_ch'])
-    o_B['w_len'] = torch.LongTensor(in_B['w_len'])
-    o_B['w'] = torch.LongTensor(in_B['w'])
-    o_B['w_chs'] = torch.LongTensor(in_B['w_chs'])
-    o_B['w_cap'] = torch.LongTensor(in_B['w_cap'])
-    o_B['w_mask'] = torch.FloatTensor(in_B['w_mask'])
-    o_B['s_len'] = torch.LongTensor(in_B['s_len'])
+    o_B['ch'] = torch.from_numpy(in_B['ch'])
+    o_B['w_len'] = torch.from_numpy(in_B['w_len'])
+    o_B['w'] = torch.from_numpy(in_B['w'])
+    o_B['w_chs'] = torch.from_numpy(in_B['w_chs'])
+    o_B['w_cap'] = torch.from_numpy(in_B['w_cap'])
+    o_B['w_mask'] = torch.from_numpy(in_B['w_mask'])
+    o_B['s_len'] = torch.from_numpy(in_B['s_len'])
 
     if in_B['tag'] is not None:
-        o_B['tag'] = torch.LongTensor(in_B['tag'])
+        o_B['tag'] = torch.from_numpy(in_B['tag'])
     else:
         o_B['tag'] = None
 
     if in_B['tag'] is not None:
-        tag_one_hot = np.zeros((cfg.d_batch_size * cfg.max_s_len, cfg.tag_size))
-        tag_one_hot[np.arange(cfg.d_batch_size * cfg.max_s_len), np.reshape(in_B['tag'], (-1,))] = 1.0
-        tag_o_h = np.reshape(tag_one_hot, (cfg.d_batch_size, cfg.max_s_len, cfg.tag_size))
-        o_B['tag_o_h'] = torch.FloatTensor(tag_o_h)
+        tag_o_h = torch.zeros(in_B['d_batch_size'], in_B['max_s_len'], cfg.tag_size)
+        o_B['tag_o_h'] = tag_o_h.scatter_(2, o_B['tag'].unsqueeze(2), 1.0)
     else:
         o_B['tag_o_h'] = None
 
-    cfg.B = o_B
+    return o_B
+
+def load_batches(cfg):
+    """Yields (batch, tensors) pairs, which are built by background workers."""
+    def work(plan):
+        batch = make_batch(cfg, plan)
+        return batch, batch_to_tensors(cfg, batch)
+
+    return prefetch(batch_plans(cfg), work, cfg.prefetch_depth, cfg.prefetch_workers)
+
+def use_batch(cfg, batch, B):
+    """Sets the current batch for the modules."""
+    cfg.d_batch_size = batch['d_batch_size']
+    cfg.max_s_len = batch['max_s_len']
+    cfg.max_w_len = batch['max_w_len']
+    cfg.B = B
     return
 
 def save_predictions(cfg, batch, preds, f):
@@ -155,12 +183,8 @@ def run_epoch(cfg):
         if cfg.model_type=='AC-RNN':
             rltrain.train()
 
-    batches = [batch for batch in load_data(cfg)]
-    shuffle(batches)
-    for step, batch in enumerate(batches):
-        cfg.d_batch_size = batch['d_batch_size']
-        cfg.max_s_len = batch['max_s_len']
-        cfg.max_w_len = batch['max_w_len']
+    for step, (batch, B) in enumerate(load_batches(cfg)):
+        use_batch(cfg, batch, B)
 
         f_opt.zero_grad()
         e_opt.zero_grad()
@@ -174,7 +198,6 @@ def run_epoch(cfg):
         else:
             m_opt.zero_grad()
 
-        batch_to_tensors(cfg, batch)
         F = feature()
         H = encoder(F)
         if cfg.model_type=='INDP':
@@ -240,7 +263,7 @@ def run_epoch(cfg):
     return
 
 def predict(cfg, o_file):
-    if cfg.mode=='train':
+    if cfg.mode=='train' or cfg.mode=='quantize':
         cfg.local_mode = 'dev'
 
     elif cfg.mode=='test':
@@ -257,13 +280,16 @@ def predict(cfg, o_file):
     else:
         mldecoder.eval()
 
+    #Decoding time and passes of the decoder RNNs in this prediction.
+    decode_time = 0.0
+    if cfg.model_type not in ['INDP', 'CRF']:
+        mldecoder.passes = 0
+        mldecoder.steps = 0
+
     #file stream to save predictions
     f = codecs.open(o_file, 'w', 'utf-8')
-    for batch in load_data(cfg):
-        cfg.d_batch_size = batch['d_batch_size']
-        cfg.max_s_len = batch['max_s_len']
-        cfg.max_w_len = batch['max_w_len']
-        batch_to_tensors(cfg, batch)
+    for batch, B in load_batches(cfg):
+        use_batch(cfg, batch, B)
         F = feature()
         H = encoder(F)
         if cfg.model_type=='INDP':
@@ -271,14 +297,35 @@ def predict(cfg, o_file):
         elif cfg.model_type=='CRF':
             preds = crf.predict(H)
         else:
+            start = time.time()
             if cfg.search=='greedy':
                 preds = mldecoder.greedy(H)[0].cpu().data.numpy()
             elif cfg.search=='beam':
                 preds = mldecoder.beam(H)[0][:,0,:].cpu().data.numpy()
+            elif cfg.search=='speculative':
+                preds = mldecoder.speculative(H)[0].cpu().data.numpy()
+            decode_time += time.time() - start
 
         save_predictions(cfg, batch, preds, f)
 
     f.close()
+    if cfg.local_mode=='test':
+        print 'Char cache hits:{} | misses:{} | hit rate:{:.3f}'.format(
+                                                feature.ch_cache.hits,
+                                                feature.ch_cache.misses,
+                                                feature.ch_cache.hit_rate()
+                                                )
+        print 'Token cache hits:{} | misses:{} | hit rate:{:.3f}'.format(
+                                                cfg.token_cache.hits,
+                                                cfg.token_cache.misses,
+                                                cfg.token_cache.hit_rate()
+                                                )
+    if cfg.model_type not in ['INDP', 'CRF'] and cfg.search=='speculative':
+        print 'Speculative passes:{} | greedy steps:{} | decoding:{:.3f} seconds'.format(
+                                                mldecoder.passes,
+                                                mldecoder.steps,
+                                                decode_time
+                                                )
     return
 
 def run_model(mode, path, in_file, o_file):
@@ -356,6 +403,9 @@ def run_model(mode, path, in_file, o_file):
         mldecoder.load_state_dict(torch.load(path + 'TF-RNN' + '_predictor'))
 
     if mode=='train':
+        #Compile the data before any prefetch thread starts.
+        if cfg.compile_corpus: compile_data(cfg)
+
         o_file = './temp.predicted_' + cfg.model_type
         best_val_cost = float('inf')
         best_val_epoch = 0
@@ -371,6 +421,7 @@ def run_model(mode, path, in_file, o_file):
                 cfg.sampling_p = float(cfg.k)/float(cfg.k + np.exp(float(epoch)/cfg.k))
 
             start = time.time()
+            cfg.epoch = epoch
             run_epoch(cfg)
             print '\nValidation:'
             predict(cfg, o_file)
@@ -399,9 +450,15 @@ def run_model(mode, path, in_file, o_file):
 
         print 'Total training time:{} seconds'.format(time.time() - first_start)
 
-    elif mode=='test':
-        cfg.batch_size = 256
+    elif mode=='test' or mode=='quantize' or mode=='script':
+        #There is no backward pass, so batches can be 8 times larger.
+        cfg.batch_size *= 8
+        if cfg.batch_tokens is not None: cfg.batch_tokens *= 8
+        if cfg.batch_chars is not None: cfg.batch_chars *= 8
+        if cfg.model_type=='CRF' and cfg.crf_top_k is None:
+            cfg.batch_size = max(1, min(cfg.batch_size, cfg.crf_batch_scores // cfg.tag_size**2))
         feature.load_state_dict(torch.load(path + cfg.model_type + '_feature'))
+        if cfg.feature_table is not None: load_feature_table(cfg, path)
         encoder.load_state_dict(torch.load(path + cfg.model_type + '_encoder'))
         if cfg.model_type=='INDP': indp.load_state_dict(torch.load(path + cfg.model_type + '_predictor'))
         elif cfg.model_type=='CRF': crf.load_state_dict(torch.load(path + cfg.model_type + '_predictor'))
@@ -411,6 +468,18 @@ def run_model(mode, path, in_file, o_file):
             mldecoder.load_state_dict(torch.load(path + cfg.model_type + '_predictor'))
             rltrain.load_state_dict(torch.load(path + cfg.model_type + '_critic'))
 
+        if mode=='quantize':
+            #Compile the data before any prefetch thread starts.
+            if cfg.compile_corpus: compile_data(cfg)
+            compare_quantized(cfg, path)
+            return
+
+        if mode=='script':
+            script_model(cfg, o_file)
+            return
+
+        if cfg.quantized: load_quantized(cfg, path)
+
         print
         print 'Model:{} Predicting'.format(cfg.model_type)
         start = time.time()
@@ -418,6 +487,167 @@ def run_model(mode, path, in_file, o_file):
         print 'Total prediction time:{} seconds'.format(time.time() - start)
     return
 
+def predictor(cfg):
+    if cfg.model_type=='INDP': return indp
+    elif cfg.model_type=='CRF': return crf
+    else: return mldecoder
+
+def quantize_model(cfg):
+    """
+        Replaces the LSTM and Linear layers of the encoder and the predictor
+        with dynamic int8 versions: weights are int8, activations are quantized on the fly.
+        Layers without a quantized version in the installed torch stay float32.
+    """
+    if quantize_dynamic is None:
+        print "INFO: This version of torch does not support dynamic quantization!"
+        exit()
+
+    if hasCuda:
+        print "INFO: Quantized inference runs on CPU only!"
+        exit()
+
+    layers = {nn.LSTM, nn.LSTMCell, nn.Linear}
+    quantize_dynamic(encoder, layers, dtype=torch.qint8, inplace=True)
+    quantize_dynamic(predictor(cfg), layers, dtype=torch.qint8, inplace=True)
+    return
+
+def load_quantized(cfg, path):
+    quantize_model(cfg)
+    encoder.load_state_dict(torch.load(path + cfg.model_type + '_encoder_int8'))
+    predictor(cfg).load_state_dict(torch.load(path + cfg.model_type + '_predictor_int8'))
+    return
+
+def dev_scores(cfg):
+    """Predicts the dev set, and returns the accuracy, F1 (only for NER) and prediction time."""
+    o_file = './temp.predicted_' + cfg.model_type
+    start = time.time()
+    predict(cfg, o_file)
+    seconds = time.time() - start
+    acc = accuracy(cfg.dev_ref, o_file)
+    f1 = None
+    if cfg.task=='en_NER' or cfg.task=='de_NER':
+        f1 = fscore(cfg)
+
+    return acc, f1, seconds
+
+def compare_quantized(cfg, path):
+    """Quantizes the loaded model, compares it with the float model on the dev set, and saves it."""
+    print
+    print 'Model:{} Float predicting'.format(cfg.model_type)
+    float_scores = dev_scores(cfg)
+
+    quantize_model(cfg)
+    print
+    print 'Model:{} Int8 predicting'.format(cfg.model_type)
+    int8_scores = dev_scores(cfg)
+
+    print
+    for name, (acc, f1, seconds) in [('Float', float_scores), ('Int8', int8_scores)]:
+        f1_str = 'F1:{:.2f} | '.format(f1) if f1 is not None else ''
+        print '{} | Accuracy:{:.2f} | {}Time:{:.2f} seconds'.format(name, acc, f1_str, seconds)
+
+    torch.save(encoder.state_dict(), path + cfg.model_type + '_encoder_int8')
+    torch.save(predictor(cfg).state_dict(), path + cfg.model_type + '_predictor_int8')
+    return
+
+def script_model(cfg, o_file):
+    """
+        Saves the TorchScript inference graph of the loaded model to o_file,
+        and the words, chars and tags of its ids to o_file.vocab.json.
+        The graph is loaded with torch.jit.load, without this code.
+    """
+    if not hasattr(torch, 'jit') or not hasattr(torch.jit, 'script'):
+        print "INFO: This version of torch does not support TorchScript!"
+        exit()
+
+    print "INFO: Scripting the {} model!".format(cfg.model_type)
+    graph = script(cfg, feature, encoder, predictor(cfg))
+    graph.save(o_file)
+
+    vocab = {
+            'words': [cfg.data['id_w'][i] for i in range(cfg.w_size)],
+            'chars': [cfg.data['id_ch'][i] for i in range(cfg.ch_size)],
+            'tags': [cfg.data['id_tag'][i] for i in range(cfg.tag_size)],
+            'unk': cfg.unk,
+            'digit': cfg.dig,
+            'time': cfg.time,
+            'date': cfg.date,
+            'w_pad_id': cfg.w_pad_id,
+            'ch_pad_id': cfg.ch_pad_id,
+            'cap_pad_id': cfg.cap_pad_id,
+            'tag_pad_id': cfg.tag_pad_id
+            }
+    with codecs.open(o_file + '.vocab.json', 'w', 'utf-8') as fd:
+        json.dump(vocab, fd, ensure_ascii=False)
+
+    return
+
+def table_stamp(cfg, path):
+    #The table depends on the feature weights, the dictionary and the chars.
+    return file_stamp([path + cfg.model_type + '_feature', cfg.w_dic, cfg.ch_dic])
+
+def load_feature_table(cfg, path):
+    """Lets the feature module read the in-vocabulary words from the exported table."""
+    if not valid_cache(cfg.feature_table, table_stamp(cfg, path)):
+        print "INFO: The feature table is missing or out of date, running without it!"
+        return
+
+    table = np.load(cfg.feature_table + '.npy', mmap_mode='r')
+    ids = np.load(cfg.feature_table + '.ids.npy')
+    feature.use_table(table, ids)
+    print "INFO: Using the feature table of {} words!".format(len(ids))
+    return
+
+def export_table(path, table_path, words_file):
+    """
+        Precomputes the prefix, suffix and word vectors of the dictionary words
+        (or the words of words_file, one per line with the word in the first field)
+        with the trained feature module:
+        table_path.npy: float32 matrix of the vectors, one row per word.
+        table_path.ids.npy: the word id of each row.
+    """
+    global feature
+    cfg = Configuration()
+    cfg.mode = 'test'
+    load_embeddings(cfg)
+
+    feature = Feature(cfg)
+    if hasCuda: feature.cuda()
+    feature.load_state_dict(torch.load(path + cfg.model_type + '_feature'))
+    feature.eval()
+
+    if words_file is None:
+        #The constants do not stand for one word string.
+        ids = np.arange(cfg.w_size - 5)
+    else:
+        w_id = cfg.data['w_id']
+        ids = []
+        with codecs.open(words_file, 'r', 'utf-8') as fd:
+            for line in fd:
+                fields = line.strip().split()
+                if len(fields)!=0:
+                    word_id = w_id.get(fields[0].lower())
+                    if word_id is not None and word_id < cfg.w_size - 5:
+                        ids.append(word_id)
+
+        #Keep the first occurrence, so frequent words come first.
+        ids = np.array(ids, dtype=np.int64)
+        ids = ids[np.sort(np.unique(ids, return_index=True)[1])]
+
+    #Words without chars go through the char RNN.
+    w_ch_off = cfg.data['w_ch_off']
+    ids = ids[w_ch_off[ids + 1] > w_ch_off[ids]]
+
+    print "INFO: Exporting the features of {} words!".format(len(ids))
+    size = 2 * cfg.ch_rnn_units + cfg.w_em_size
+    table = np.lib.format.open_memmap(table_path + '.npy', mode='w+', dtype=np.float32, shape=(len(ids), size))
+    feature.build_table(ids, table)
+    table.flush()
+    del table
+    np.save(table_path + '.ids.npy', ids)
+    save_cache_stamp(table_path, table_stamp(cfg, path))
+    return
+
 """
     For training: python tagger.py train <path to save model>
     example: python tagger.py train ./saved_models/
@@ -425,14 +655,39 @@ def run_model(mode, path, in_file, o_file):
     For testing: python tagger.py test <path to restore model> <input file path> <output file path>
     example: python tagger.py test ./saved_models/ ./data/test.raw ./saved_models/test.predicted
     or: python tagger.py test ./saved_models/ ./data/dev.raw ./saved_models/dev.predicted
+
+    For compiling the train and dev sets ahead of training: python tagger.py compile
+
+    For quantizing a trained model, and comparing it with the float model on the dev set:
+    python tagger.py quantize <path to restore model>
+    Set quantized = True in config.py to test with the quantized model.
+
+    For saving the TorchScript inference graph of a trained model: python tagger.py script <path to restore model> <output file path>
+    example: python tagger.py script ./saved_models/ ./saved_models/tagger.pt
+
+    For exporting the feature table of a trained model: python tagger.py export <path to restore model> <table path> [word list]
+    example: python tagger.py export ./saved_models/ ./saved_models/features
 """
 if __name__ == "__main__":
     mode = sys.argv[1]
+    if mode=='compile':
+        cfg = Configuration()
+        load_embeddings(cfg)
+        compile_data(cfg)
+        exit()
+
+    if mode=='export':
+        words_file = sys.argv[4] if len(sys.argv) > 4 else None
+        export_table(sys.argv[2], sys.argv[3], words_file)
+        exit()
+
     path = sys.argv[2]
     in_file = None
     o_file = None
     if mode=='test':
         in_file = sys.argv[3]
         o_file = sys.argv[4]
+    elif mode=='script':
+        o_file = sys.argv[3]
 
     run_model(mode, path, in_file, o_file)